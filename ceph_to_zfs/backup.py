@@ -1,13 +1,22 @@
-import os
+import contextlib
+import dataclasses
+import threading
 import traceback
 from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-
-import libzfs
+from typing import Optional, Callable, ContextManager
 
 from ceph_to_zfs import statuslogger
-from ceph_to_zfs.zfs_support import ZfsDatasetContext, zfs_snapshot_name, ZfsContext
-from ceph_to_zfs.configuration_options import ImageFilter
+from ceph_to_zfs.zfs_support import ZfsDatasetContext, zfs_snapshot_name, ZfsContext, LAST_READ_BYTES_PROPERTY, \
+    LAST_SNAPSHOT_PROPERTY
+from ceph_to_zfs.buffers import BufferPool
+from ceph_to_zfs.extents import ExtentCoalescer
+from ceph_to_zfs.hashindex import BlockHashIndex
+from ceph_to_zfs.snapshots import SnapshotBatcher
+from ceph_to_zfs.concurrency import ConcurrencyLimiter, AdaptiveConcurrencyLimiter
+from ceph_to_zfs.configuration_options import PoolConfig, DiffMode
+from ceph_to_zfs.transfer import TransferPipeline, TransferFailed, TransferStats
+from ceph_to_zfs.writers import PwriteWriter, DirectWriter, UringWriter
 
 try:
     import rados
@@ -24,23 +33,195 @@ def format_exception(e: Exception) -> str:
     return ''.join(traceback.format_exception(e.__class__, e, e.__traceback__))
 
 
-def do_backup(log: JobLogger, ceph_rbd_image: rbd.Image, zfs_dest: ZfsDatasetContext):
+def rbd_snapshot_ids(ceph_rbd_image: rbd.Image) -> dict[str, int]:
+    return {snap['name']: snap['id'] for snap in ceph_rbd_image.list_snaps()}
+
+
+def find_latest_common_snapshot(ceph_rbd_image: rbd.Image, zfs_dest: ZfsDatasetContext) -> Optional[str]:
+    """
+    Name of the newest snapshot which exists on both the RBD image and the destination zvol, if any. The snapshot
+    recorded by the last successful backup is tried first, so the zvol's snapshots usually don't need to be listed.
+    """
+    src_snap_ids = rbd_snapshot_ids(ceph_rbd_image)
+    stale_name = None
+    recorded = zfs_dest.get_user_property(LAST_SNAPSHOT_PROPERTY)
+    if recorded:
+        name, _, snap_id = recorded.rpartition('@')
+        if snap_id.isdigit() and src_snap_ids.get(name) == int(snap_id):
+            if zfs_dest.has_snapshot(name):
+                return name
+        else:
+            # A snapshot which was deleted and re-created under the same name has a new id, and different data
+            stale_name = name
+    # all_snapshots is sorted by creation time
+    for snap in reversed(zfs_dest.all_snapshots):
+        snap_name = zfs_snapshot_name(snap)
+        if snap_name in src_snap_ids and snap_name != stale_name:
+            return snap_name
+    return None
+
+
+def has_fast_diff(ceph_rbd_image: rbd.Image) -> bool:
+    """
+    Whether librbd can compute diffs for the image from its object map rather than by examining every object.
+    """
+    if not ceph_rbd_image.features() & rbd.RBD_FEATURE_FAST_DIFF:
+        return False
+    return not ceph_rbd_image.flags() & (rbd.RBD_FLAG_OBJECT_MAP_INVALID | rbd.RBD_FLAG_FAST_DIFF_INVALID)
+
+
+def choose_diff_mode(ceph_rbd_image: rbd.Image, configured: DiffMode) -> DiffMode:
+    """
+    The diff mode to back up an image with. AUTO never picks WHOLE_OBJECT, which rewrites every changed object in
+    full and makes the zvol's snapshots grow by that much.
+    """
+    if configured != DiffMode.AUTO:
+        return configured
+    return DiffMode.TWO_LEVEL if has_fast_diff(ceph_rbd_image) else DiffMode.FINE
+
+
+def diff_extents(ceph_rbd_image: rbd.Image, offset: int, length: int, from_snapshot: Optional[str],
+                 callback: Callable[[int, int, bool], None], diff_mode: DiffMode):
+    """
+    Call callback(offset, length, exists) for each changed extent in a range of the image, using diff_mode.
+    """
+    if diff_mode != DiffMode.TWO_LEVEL:
+        # This is a third party function which calls 'callback' repeatedly
+        ceph_rbd_image.diff_iterate(
+            offset=offset,
+            length=length,
+            from_snapshot=from_snapshot,
+            iterate_cb=callback,
+            include_parent=True,
+            whole_object=diff_mode == DiffMode.WHOLE_OBJECT
+        )
+        return
+
+    # Coarse pass: find the changed objects, merging adjacent ones into runs
+    changed: list[list] = []
+
+    def collect(extent_offset: int, extent_length: int, exists: bool):
+        if changed and changed[-1][2] == exists and changed[-1][0] + changed[-1][1] == extent_offset:
+            changed[-1][1] += extent_length
+        else:
+            changed.append([extent_offset, extent_length, exists])
+
+    ceph_rbd_image.diff_iterate(
+        offset=offset,
+        length=length,
+        from_snapshot=from_snapshot,
+        iterate_cb=collect,
+        include_parent=True,
+        whole_object=True
+    )
+    # Fine pass: objects which no longer exist are all zeroes, so only objects with data need an exact diff
+    for run_offset, run_length, exists in changed:
+        if not exists:
+            callback(run_offset, run_length, exists)
+            continue
+        ceph_rbd_image.diff_iterate(
+            offset=run_offset,
+            length=run_length,
+            from_snapshot=from_snapshot,
+            iterate_cb=callback,
+            include_parent=True,
+            whole_object=False
+        )
+
+
+def extent_coalescer(submit: Callable[[int, int, bool], None], zfs_dest: ZfsDatasetContext, img_bytes: int,
+                     obj_size: int, pool_config: PoolConfig) -> ExtentCoalescer:
+    # Merged extents are capped at the object size so that they still fit in a pooled buffer
+    align = pool_config.align_to_volblocksize and zfs_dest.volume is not None
+    return ExtentCoalescer(submit, image_size=img_bytes, block_size=zfs_dest.volblocksize if align else 1,
+                           max_gap=pool_config.coalesce_gap, max_length=obj_size)
+
+
+def estimate_transfer_bytes(ceph_rbd_image: rbd.Image, zfs_dest: ZfsDatasetContext, from_snapshot: Optional[str],
+                            diff_mode: DiffMode, pool_config: PoolConfig) -> int:
+    """
+    Sum the lengths of the extents a backup from from_snapshot to the image's current state would read, without
+    reading any data. The extents are found with diff_mode and coalesced like do_backup does. Extents which do not
+    exist are not counted, since they are discarded rather than read.
+    """
+    total = [0]
+
+    def count_extent(offset: int, length: int, exists: bool):
+        if exists:
+            total[0] += length
+
+    coalescer = extent_coalescer(count_extent, zfs_dest, ceph_rbd_image.size(), ceph_rbd_image.stat()['obj_size'],
+                                 pool_config)
+    diff_extents(ceph_rbd_image, 0, (2 ** 62) - 1, from_snapshot, coalescer, diff_mode)
+    coalescer.flush()
+    return total[0]
+
+
+def shard_ranges(img_bytes: int, obj_size: int, pool_config: PoolConfig) -> list[tuple[int, int]]:
+    """
+    Split an image into (offset, length) ranges which can be transferred in parallel.
+
+    Shards are aligned to the RBD object size, and no shard is smaller than pool_config.min_shard_size unless the
+    whole image is.
+    """
+    if img_bytes <= 0:
+        return []
+    count = max(1, min(pool_config.shards_per_image, img_bytes // max(pool_config.min_shard_size, 1)))
+    shard_bytes = -(-img_bytes // count)
+    shard_bytes = -(-shard_bytes // obj_size) * obj_size
+    return [(offset, min(shard_bytes, img_bytes - offset)) for offset in range(0, img_bytes, shard_bytes)]
+
+
+def open_hash_index(log: JobLogger, zfs_dest: ZfsDatasetContext, base_snapshot: Optional[str], img_bytes: int,
+                    pool_config: PoolConfig) -> Optional[BlockHashIndex]:
+    """
+    Open the block hash index of a prepared zvol, if enabled, and mark it as being written.
+
+    The index is only kept if it describes the snapshot the zvol was just rolled back to.
+    """
+    if pool_config.block_hash_index_dir is None:
+        return None
+    hash_index = BlockHashIndex.for_dataset(pool_config.block_hash_index_dir, zfs_dest.zfs_path,
+                                            zfs_dest.volblocksize, img_bytes)
+    try:
+        base_guid = None if zfs_dest.created or base_snapshot is None else zfs_dest.snapshot_guid(base_snapshot)
+        if not hash_index.valid_for(base_guid):
+            log.log(f'Block hash index {hash_index.path} does not match the base snapshot, starting over')
+            hash_index.reset()
+        hash_index.mark_dirty()
+    except Exception:
+        hash_index.close()
+        raise
+    return hash_index
+
+
+@dataclasses.dataclass
+class FinishedTransfer:
+    """
+    An image whose data has been written to its zvol, which finalize_backup() still has to snapshot.
+    """
+    log: JobLogger
+    zfs_dest: ZfsDatasetContext
+    snapshot_name: str
+    rbd_snapshot_id: int
+    img_bytes: int
+    stats: TransferStats
+    hash_index: Optional[BlockHashIndex]
+
+
+def do_backup(log: JobLogger, ceph_pool: rados.Ioctx, ceph_rbd_image: rbd.Image, zfs_dest: ZfsDatasetContext,
+              pool_config: PoolConfig, snapshot_batcher: Optional[SnapshotBatcher] = None) -> TransferStats:
+    return finalize_backup(transfer_image(log, ceph_pool, ceph_rbd_image, zfs_dest, pool_config), snapshot_batcher)
+
+
+def transfer_image(log: JobLogger, ceph_pool: rados.Ioctx, ceph_rbd_image: rbd.Image, zfs_dest: ZfsDatasetContext,
+                   pool_config: PoolConfig) -> FinishedTransfer:
     log.status_text = 'Calculating backup'
     log.status_type = statuslogger.In_Progress
     try:
         # This is an incremental backup when possible, else full backup.
         # First, we need to figure out our snapshot to use as a basis for incremental (or lack thereof).
-        src_snaps: list[dict] = list(ceph_rbd_image.list_snaps())
-        src_snap_names: list[str] = [snap['name'] for snap in src_snaps]
-        # print(f'Source snapshots: {src_snap_names}')
-        dest_snaps: list[libzfs.ZFSSnapshot] = zfs_dest.all_snapshots
-        dest_snap_names: list[str] = [zfs_snapshot_name(snap) for snap in dest_snaps]
-        # print(f'Dest snapshots: {dest_snap_names}')
-        common_snaps: list[str] = [snap_name for snap_name in dest_snap_names if snap_name in src_snap_names]
-        if common_snaps:
-            latest_common_snap = common_snaps[-1]
-        else:
-            latest_common_snap = None
+        latest_common_snap = find_latest_common_snapshot(ceph_rbd_image, zfs_dest)
 
         now = datetime.utcnow()
         now_fmt = now.strftime('%Y-%m-%d-%H:%M:%S')
@@ -59,73 +240,162 @@ def do_backup(log: JobLogger, ceph_rbd_image: rbd.Image, zfs_dest: ZfsDatasetCon
         img_bytes = ceph_rbd_image.size()
         log.log(f'Image size: {img_bytes}')
 
-        zfs_dest.prepare(latest_common_snap, img_bytes)
+        zfs_dest.prepare(latest_common_snap, img_bytes, pool_config.device_timeout)
 
         dev_path = zfs_dest.device_node
         log.log(f'Going to write to {dev_path}')
 
-        # TODO: does overwriting with the same data use extra space in ZFS?
-        requested = [0]
-        written = [0]
-        failures = []
-        # TODO: if the system is slow, this will not work correctly, as udev can't fix disk permissions fast enough
-        # with open(dev_path, 'rb+', 1024 * 1024 * 64, closefd=True) as dev:
-        with open(dev_path, 'rb+', 0, closefd=True) as dev:
-            def callback_inner(offset: int, length: int, exists: bool):
-                # time.sleep(1)
-                # print(f'[{img_name}] Thread: {threading.get_ident()}')
-                requested[0] += length
-                try:
-                    dev.seek(offset, os.SEEK_SET)
-                    dev.write(ceph_rbd_image.read(offset, length, 0))
-                    dev.flush()
-                except Exception as e:
-                    log.log(
-                        f'FAILED WRITE - {length} bytes from {offset} to {offset + length - 1} (exists: {exists})\n{e}')
-                    failures.append(e)
-                    raise
-                # print(
-                #     f'[{img_name}]: Successful write - {length} bytes from {offset} to {offset + length - 1} (exists: {exists})')
-                written[0] += length
+        discard_block_size = zfs_dest.volblocksize if pool_config.discard_zero_extents else None
+        # A zvol we just created is sparse and reads back as zeroes, so there is no need to write zeroes to it
+        if zfs_dest.created and pool_config.skip_zeroes_on_new_zvol:
+            log.log('Destination zvol is new, skipping zero data')
+            zero_chunk_size = zfs_dest.volblocksize
+        else:
+            zero_chunk_size = None
+        if zero_chunk_size is None and pool_config.compare_before_write:
+            log.log('Comparing data against the destination zvol before writing')
+            compare_chunk_size = zfs_dest.volblocksize
+        else:
+            compare_chunk_size = None
+        diff_mode = choose_diff_mode(ceph_rbd_image, pool_config.diff_mode)
+        log.log(f'Using {diff_mode.value} diff')
+        obj_size = ceph_rbd_image.stat()['obj_size']
+        shards = shard_ranges(img_bytes, obj_size, pool_config)
+        # diff_iterate reports changes per object, so object-sized buffers fit almost every extent. Anything larger
+        # falls back to read().
+        buffer_pool = BufferPool(obj_size) if hasattr(ceph_rbd_image, 'readinto') else None
+        # Set when any shard fails, so the others stop queueing extents
+        shard_failed = threading.Event()
+
+        def transfer_shard(image: rbd.Image, offset: int, length: int) -> TransferPipeline:
+            pipeline = TransferPipeline(log, lambda offset, length: image.read(offset, length, 0), device,
+                                        read_workers=pool_config.read_workers,
+                                        queue_depth=pool_config.queue_depth,
+                                        max_bytes_in_flight=pool_config.max_bytes_in_flight // max(len(shards), 1),
+                                        discard_block_size=discard_block_size,
+                                        zero_chunk_size=zero_chunk_size,
+                                        compare_chunk_size=compare_chunk_size,
+                                        hash_index=hash_index,
+                                        readinto_func=getattr(image, 'readinto', None),
+                                        buffer_pool=buffer_pool,
+                                        aio_image=image if pool_config.aio_reads else None)
+
+            def submit(offset: int, length: int, exists: bool):
+                if shard_failed.is_set():
+                    raise TransferFailed('Another shard of this image failed')
+                pipeline.submit(offset, length, exists)
+
+            coalescer = extent_coalescer(submit, zfs_dest, img_bytes, obj_size, pool_config)
+            try:
+                with pipeline:
+                    diff_extents(image, offset, length, latest_common_snap, coalescer, diff_mode)
+                    coalescer.flush()
+            except Exception:
+                shard_failed.set()
+                raise
+            return pipeline
 
+        def open_and_transfer_shard(offset: int, length: int) -> TransferPipeline:
+            # Each shard gets its own image handle, opened at the snapshot we are backing up
+            with rbd.Image(ceph_pool, img_name, snapshot=new_snap_name, read_only=True) as image:
+                return transfer_shard(image, offset, length)
+
+        # Positional writes, so all shards can share one writer
+        if pool_config.io_uring:
+            writer_class = UringWriter
+        elif pool_config.direct_io:
+            writer_class = DirectWriter
+        else:
+            writer_class = PwriteWriter
+        with contextlib.ExitStack() as stack:
+            device = stack.enter_context(writer_class(dev_path))
+            hash_index = open_hash_index(log, zfs_dest, latest_common_snap, img_bytes, pool_config)
+            if hash_index is not None:
+                stack.enter_context(hash_index)
+            if pool_config.io_uring and not device.using_io_uring:
+                log.log('io_uring is not available, falling back to pwrite')
             log.log_status('Writing data')
-            # This is a third party function which calls 'callback' repeatedly
-            ceph_rbd_image.diff_iterate(
-                offset=0,
+            if len(shards) <= 1:
                 # Length can be larger than needed
-                length=(2 ** 62) - 1,
-                from_snapshot=latest_common_snap,
-                iterate_cb=callback_inner,
-                include_parent=True,
-                whole_object=False
-            )
-
-            log.log_status('Flushing')
-            dev.flush()
-            log.log_status(f'Flushed')
+                pipelines = [transfer_shard(ceph_rbd_image, 0, (2 ** 62) - 1)]
+            else:
+                log.log(f'Transferring {len(shards)} shards of {shards[0][1]} bytes in parallel')
+                with ThreadPoolExecutor(max_workers=len(shards)) as shard_pool:
+                    futures = [shard_pool.submit(open_and_transfer_shard, offset, length)
+                               for offset, length in shards]
+                # Raises the first shard failure, if any
+                pipelines = [future.result() for future in futures]
 
+        failures = [failure for pipeline in pipelines for failure in pipeline.failures]
+        stats = sum((pipeline.stats for pipeline in pipelines), TransferStats())
         if failures:
-            log.log_status(f'FAILED! One or more writes failed, see log. Wrote {written[0]}/{requested[0]} bytes to {dev_path}')
+            log.log_status(f'FAILED! One or more writes failed, see log. Wrote {stats.written}/{stats.requested} bytes to {dev_path}')
             raise Exception(f'There were {len(failures)} failure(s)!!! Not snapshotting!')
         else:
-            log.log_status(f'Finished writing {written[0]}/{requested[0]} bytes to {dev_path}')
+            log.log_status(f'Finished writing {stats.written}/{stats.requested} bytes to {dev_path} '
+                           f'({stats.discarded} bytes discarded, {stats.skipped} zero bytes skipped, '
+                           f'{stats.unchanged} unchanged bytes skipped)')
+
+        return FinishedTransfer(log=log, zfs_dest=zfs_dest, snapshot_name=new_snap_name,
+                                rbd_snapshot_id=rbd_snapshot_ids(ceph_rbd_image)[new_snap_name],
+                                img_bytes=img_bytes, stats=stats, hash_index=hash_index)
+    except Exception as e:
+        log.log_status(f'FAILED! {e}', statuslogger.Failed)
+        log.log(f'Error in {ceph_rbd_image.get_name()}: {format_exception(e)}')
+        raise
 
+
+def finalize_backup(finished: FinishedTransfer, snapshot_batcher: Optional[SnapshotBatcher] = None) -> TransferStats:
+    """
+    Snapshot the zvol of a finished transfer. Needs neither the RBD image nor a worker slot.
+    """
+    log, zfs_dest, new_snap_name = finished.log, finished.zfs_dest, finished.snapshot_name
+    try:
         log.log_status(f'Creating snapshot {zfs_dest.zfs_path}@{new_snap_name}')
-        zfs_dest.create_snapshot(new_snap_name)
+        if snapshot_batcher is not None:
+            snapshot_batcher.create_snapshot(zfs_dest, new_snap_name)
+        else:
+            zfs_dest.create_snapshot(new_snap_name)
+        zfs_dest.set_user_property(LAST_READ_BYTES_PROPERTY, str(finished.stats.read_bytes))
+        # Lets the next backup find its base snapshot without matching up every snapshot
+        zfs_dest.set_user_property(LAST_SNAPSHOT_PROPERTY, f'{new_snap_name}@{finished.rbd_snapshot_id}')
+        hash_index = finished.hash_index
+        if hash_index is not None:
+            # The index now describes the new snapshot, so the next incremental can trust it
+            with BlockHashIndex(hash_index.path, hash_index.block_size, finished.img_bytes) as finished_index:
+                finished_index.mark_clean(zfs_dest.snapshot_guid(new_snap_name))
         log.log_status(f'Finalized destination snapshot {zfs_dest.zfs_path}@{new_snap_name}', statuslogger.Success)
+        return finished.stats
     except Exception as e:
         log.log_status(f'FAILED! {e}', statuslogger.Failed)
-        log.log(f'Error in {ceph_rbd_image.get_name()}: {format_exception(e)}')
+        log.log(f'Error in {zfs_dest.name}: {format_exception(e)}')
         raise
 
 
 class PoolBackupController(Loggable):
-    def __init__(self, logger: JobLogger, ceph_pool: rados.Ioctx, zfs_dest: ZfsContext, image_filter: ImageFilter):
+    def __init__(self, logger: JobLogger, ceph_pool: rados.Ioctx, zfs_dest: ZfsContext, pool_config: PoolConfig,
+                 default_image_workers: int = 2,
+                 scheduler_slot: Optional[Callable[[], ContextManager]] = None):
         super().__init__(logger)
         self.ceph_pool = ceph_pool
         self.zfs_dest = zfs_dest
         self.rbd = rbd.RBD()
-        self.image_filter = image_filter
+        self.pool_config = pool_config
+        self.image_filter = pool_config.image_filter
+        # Taken for each image on top of our own limit, to share a global budget with other pools
+        self.scheduler_slot = scheduler_slot or contextlib.nullcontext
+        image_workers = pool_config.image_workers or default_image_workers
+        if pool_config.adaptive_image_workers:
+            self.limiter = AdaptiveConcurrencyLimiter(logger, image_workers, maximum=pool_config.max_image_workers)
+            self.max_workers = pool_config.max_image_workers
+        else:
+            self.limiter = ConcurrencyLimiter(image_workers)
+            self.max_workers = image_workers
+        if pool_config.batch_snapshots:
+            self.snapshot_batcher = SnapshotBatcher(logger, pool_config.snapshot_batch_size,
+                                                    pool_config.snapshot_batch_delay)
+        else:
+            self.snapshot_batcher = None
 
     @property
     def all_image_names(self) -> list[str]:
@@ -136,26 +406,115 @@ class PoolBackupController(Loggable):
         return self.image_filter.should_backup(image_name)
 
     @property
-    def images_to_back_up(self) -> list[rbd.Image]:
-        return [rbd.Image(self.ceph_pool, image_name, read_only=False) for image_name in self.all_image_names if
-                self.should_backup_image(image_name)]
+    def images_to_back_up(self) -> list[str]:
+        """
+        Names of the images to back up.
+
+        Images are only opened when their backup starts, see backup_image().
+        """
+        return [image_name for image_name in self.all_image_names if self.should_backup_image(image_name)]
+
+    def plan_image(self, image_context: JobLogger, image_name: str) -> Optional[int]:
+        """
+        Estimate how many bytes backing up an image will read, and record it for progress reporting.
+
+        Returns None if the estimate failed, which does not stop the image from being backed up.
+        """
+        try:
+            with rbd.Image(self.ceph_pool, image_name, read_only=True) as image:
+                zdc = ZfsDatasetContext(image_context, self.zfs_dest, image_name)
+                base = find_latest_common_snapshot(image, zdc)
+                if self.pool_config.plan_whole_object:
+                    diff_mode = DiffMode.WHOLE_OBJECT
+                else:
+                    diff_mode = choose_diff_mode(image, self.pool_config.diff_mode)
+                expected = estimate_transfer_bytes(image, zdc, base, diff_mode, self.pool_config)
+        except Exception as e:
+            image_context.log(f'Could not estimate transfer size: {e}')
+            return None
+        image_context.set_expected_bytes(expected)
+        image_context.log(f'Expecting to transfer {expected} bytes ({"incremental from " + base if base else "full"})')
+        return expected
+
+    def plan(self, image_contexts: dict[str, JobLogger]) -> dict[str, int]:
+        """
+        Estimate the transfer size of every image before any data moves.
+        """
+        self.log_status(f'Estimating transfer size of {len(image_contexts)} images')
+        with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            futures = {image_name: pool.submit(self.plan_image, image_context, image_name)
+                       for image_name, image_context in image_contexts.items()}
+        estimates = {image_name: future.result() for image_name, future in futures.items()}
+        plan = {image_name: estimate for image_name, estimate in estimates.items() if estimate is not None}
+        self.log(f'Expecting to transfer {sum(plan.values())} bytes from {len(plan)} images')
+        return plan
+
+    def predicted_transfer_bytes(self, image_name: str) -> int:
+        """
+        Guess how many bytes backing up an image will read: the bytes read by the previous run if there was one, else
+        the size of its zvol, else the size of the image. Returns 0 if that fails, e.g. if the image was deleted.
+        """
+        try:
+            zdc = ZfsDatasetContext(self.logger, self.zfs_dest, image_name)
+            last_read_bytes = zdc.get_user_property(LAST_READ_BYTES_PROPERTY)
+            if last_read_bytes is not None and last_read_bytes.isdigit():
+                return int(last_read_bytes)
+            volume = zdc.volume
+            if volume is not None:
+                return volume.properties['volsize'].parsed
+            with rbd.Image(self.ceph_pool, image_name, read_only=True) as image:
+                return image.size()
+        except Exception as e:
+            self.log(f'Could not predict the transfer size of {image_name}: {e}')
+            return 0
+
+    def backup_image(self, image_context: JobLogger, image_name: str, zdc: ZfsDatasetContext):
+        try:
+            with self.limiter.slot(), self.scheduler_slot():
+                # Open the image only for as long as we are working on it
+                with rbd.Image(self.ceph_pool, image_name, read_only=False) as image:
+                    finished = transfer_image(image_context, self.ceph_pool, image, zdc, self.pool_config)
+            # Outside the slots, so that other images can run while the snapshot waits for its batch
+            stats = finalize_backup(finished, self.snapshot_batcher)
+        except Exception as e:
+            image_context.log_status(f"Image {image_name} failed! Exception: {e}", Failed)
+        else:
+            if isinstance(self.limiter, AdaptiveConcurrencyLimiter):
+                self.limiter.record(stats.written, stats.mean_read_latency)
 
     def backup_all_images(self):
-        images = self.images_to_back_up
-        self.log(f'Going to back up {len(images)} images')
-        with ThreadPoolExecutor(max_workers=2) as pool:
-            for image in images:
-                image_context = self.logger.make_or_replace_child(image.get_name(), True)
-                image_context.status_text = 'Starting'
-                zdc = ZfsDatasetContext(image_context, self.zfs_dest, image.get_name())
-                image_context.log_status(f'Backing up image {image.get_name()} to {zdc.zfs_path}')
+        image_names = self.images_to_back_up
+        self.log(f'Going to back up {len(image_names)} images')
+        image_contexts: dict[str, JobLogger] = {}
+        for image_name in image_names:
+            image_context = self.logger.make_or_replace_child(image_name, True)
+            image_context.status_text = 'Waiting'
+            image_contexts[image_name] = image_context
+        plan = self.plan(image_contexts) if self.pool_config.plan_before_backup else {}
+        predictions: dict[str, int] = {}
 
-                def backf(image_context=image_context, image=image, zdc=zdc):
-                    try:
-                        do_backup(image_context, image, zdc)
-                    except Exception as e:
-                        image_context.log_status(f"Image {image.get_name()} failed! Exception: {e}", Failed)
+        def predicted_bytes(image_name: str) -> int:
+            if image_name in plan:
+                return plan[image_name]
+            if not predictions:
+                # Images which were never backed up have to be opened, so predict them all at once, in parallel
+                unplanned = [name for name in image_names if name not in plan]
+                with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+                    predictions.update(zip(unplanned, pool.map(self.predicted_transfer_bytes, unplanned)))
+            return predictions[image_name]
 
-                pool.submit(backf)
+        image_names = self.pool_config.image_ordering.order(image_names, predicted_bytes)
+        # The limiter decides how many images run at once. Images waiting for their snapshot batch have given up
+        # their slot, but still need a thread.
+        threads = self.max_workers
+        if self.snapshot_batcher is not None:
+            threads += self.snapshot_batcher.max_batch
+        with ThreadPoolExecutor(max_workers=threads) as pool:
+            for image_name in image_names:
+                image_context = image_contexts[image_name]
+                image_context.status_text = 'Starting'
+                zdc = ZfsDatasetContext(image_context, self.zfs_dest, image_name)
+                image_context.log_status(f'Backing up image {image_name} to {zdc.zfs_path}')
+                pool.submit(self.backup_image, image_context, image_name, zdc)
             pool.shutdown(wait=True, cancel_futures=False)
         self.log_status('Complete')
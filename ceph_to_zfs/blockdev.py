@@ -0,0 +1,167 @@
+import ctypes
+import ctypes.util
+import errno
+import fcntl
+import os
+import select
+import stat
+import struct
+import time
+from typing import Optional
+
+# From linux/fs.h
+BLKDISCARD = 0x1277
+BLKZEROOUT = 0x127f
+
+# From linux/falloc.h
+FALLOC_FL_KEEP_SIZE = 0x01
+FALLOC_FL_PUNCH_HOLE = 0x02
+
+# Largest single write used when we have to fall back to writing zeroes by hand
+_ZERO_CHUNK = 1024 * 1024
+_zero_chunk = bytes(_ZERO_CHUNK)
+
+_libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+_libc.fallocate.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_int64, ctypes.c_int64]
+_libc.fallocate.restype = ctypes.c_int
+
+# From linux/inotify.h
+IN_ATTRIB = 0x004
+IN_MOVED_TO = 0x080
+IN_CREATE = 0x100
+_WATCH_MASK = IN_ATTRIB | IN_MOVED_TO | IN_CREATE
+# Check for the device at least this often, in case an event is missed
+_WAIT_RECHECK = 1.0
+# How often to check when inotify is not available
+_WAIT_POLL = 0.05
+
+# errnos meaning "this device or file can't do that", as opposed to a real I/O failure
+_UNSUPPORTED = (errno.EOPNOTSUPP, errno.ENOTTY, errno.EINVAL, errno.ENOSYS)
+
+
+def write_zeroes(fd: int, offset: int, length: int):
+    """
+    Write literal zeroes over a range. This is the slow path used when nothing better is supported.
+    """
+    end = offset + length
+    while offset < end:
+        count = os.pwrite(fd, memoryview(_zero_chunk)[:min(_ZERO_CHUNK, end - offset)], offset)
+        offset += count
+
+
+def _punch_hole(fd: int, offset: int, length: int):
+    ret = _libc.fallocate(fd, FALLOC_FL_PUNCH_HOLE | FALLOC_FL_KEEP_SIZE, offset, length)
+    if ret != 0:
+        err = ctypes.get_errno()
+        raise OSError(err, os.strerror(err))
+
+
+def _blk_ioctl(fd: int, request: int, offset: int, length: int):
+    fcntl.ioctl(fd, request, struct.pack('QQ', offset, length))
+
+
+def zero_range(fd: int, offset: int, length: int, block_size: int):
+    """
+    Make a range of a zvol (or a regular file) read back as zeroes, freeing the space where possible.
+
+    Whole blocks are discarded with BLKDISCARD, falling back to BLKZEROOUT and then zero writes, and the unaligned
+    head and tail are written as zeroes. A regular file is hole-punched instead.
+    """
+    if length <= 0:
+        return
+    mode = os.fstat(fd).st_mode
+    if stat.S_ISREG(mode):
+        try:
+            _punch_hole(fd, offset, length)
+        except OSError as e:
+            if e.errno not in _UNSUPPORTED:
+                raise
+            write_zeroes(fd, offset, length)
+        return
+
+    end = offset + length
+    aligned_start = -(-offset // block_size) * block_size
+    aligned_end = end // block_size * block_size
+    if aligned_end <= aligned_start:
+        write_zeroes(fd, offset, length)
+        return
+    if offset < aligned_start:
+        write_zeroes(fd, offset, aligned_start - offset)
+    if aligned_end < end:
+        write_zeroes(fd, aligned_end, end - aligned_end)
+    for request in (BLKDISCARD, BLKZEROOUT):
+        try:
+            _blk_ioctl(fd, request, aligned_start, aligned_end - aligned_start)
+            return
+        except OSError as e:
+            if e.errno not in _UNSUPPORTED:
+                raise
+    write_zeroes(fd, aligned_start, aligned_end - aligned_start)
+
+
+def device_ready(path: str) -> bool:
+    """
+    Whether a device node exists and we are allowed to open it read-write.
+    """
+    return os.path.exists(path) and os.access(path, os.R_OK | os.W_OK)
+
+
+def _watch_target(path: str) -> str:
+    """
+    The path itself if it exists, so we hear about permission changes, or else the deepest directory leading to it
+    which exists, so we hear about it (or the next directory) being created.
+    """
+    while not os.path.exists(path):
+        parent = os.path.dirname(path)
+        if parent == path:
+            break
+        path = parent
+    return path
+
+
+def _inotify_init() -> Optional[int]:
+    try:
+        fd = _libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+    except AttributeError:
+        return None
+    return fd if fd >= 0 else None
+
+
+def wait_for_device(path: str, timeout: float):
+    """
+    Wait until a device node exists and udev has set its permissions so that we can open it read-write, using
+    inotify if available. Raises TimeoutError if the device is not ready within timeout seconds.
+    """
+    deadline = time.monotonic() + timeout
+    inotify_fd = None if device_ready(path) else _inotify_init()
+    try:
+        while not device_ready(path):
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                if os.path.exists(path):
+                    raise TimeoutError(f'{path} exists, but was not writable after {timeout}s')
+                raise TimeoutError(f'{path} did not appear after {timeout}s')
+            watch = -1
+            if inotify_fd is not None:
+                watch = _libc.inotify_add_watch(inotify_fd, os.fsencode(_watch_target(path)), _WATCH_MASK)
+            if watch < 0:
+                time.sleep(min(_WAIT_POLL, remaining))
+                continue
+            try:
+                # It may have become ready before the watch was added
+                if device_ready(path):
+                    break
+                readable, _, _ = select.select([inotify_fd], [], [], min(_WAIT_RECHECK, remaining))
+                if readable:
+                    # We only care that something happened, not what
+                    try:
+                        while os.read(inotify_fd, 4096):
+                            pass
+                    except BlockingIOError:
+                        pass
+            finally:
+                # Fails harmlessly if the watched path went away
+                _libc.inotify_rm_watch(inotify_fd, watch)
+    finally:
+        if inotify_fd is not None:
+            os.close(inotify_fd)
@@ -0,0 +1,160 @@
+import ctypes
+import ctypes.util
+import mmap
+import threading
+from typing import Callable
+
+_libc = ctypes.CDLL(ctypes.util.find_library('c'))
+_libc.memcmp.argtypes = [ctypes.c_void_p, ctypes.c_void_p, ctypes.c_size_t]
+_libc.memcmp.restype = ctypes.c_int
+
+_zero_chunks: dict[int, bytes] = {}
+
+
+def _zero_chunk(size: int) -> bytes:
+    chunk = _zero_chunks.get(size)
+    if chunk is None:
+        chunk = _zero_chunks.setdefault(size, bytes(size))
+    return chunk
+
+
+def _chunk_runs(length: int, base_offset: int, chunk_size: int,
+                is_unchanged: Callable[[int, int], bool]) -> list[tuple[int, int]]:
+    """
+    Split a buffer of length bytes on chunk_size boundaries of the device, and return (start, end) pairs for each
+    run of consecutive chunks for which is_unchanged(start, end) is false.
+    """
+    runs: list[tuple[int, int]] = []
+    run_start = None
+    start = 0
+    # The first chunk may be short if the buffer does not start on a chunk boundary
+    end = min(length, chunk_size - base_offset % chunk_size)
+    while start < length:
+        if is_unchanged(start, end):
+            if run_start is not None:
+                runs.append((run_start, start))
+                run_start = None
+        elif run_start is None:
+            run_start = start
+        start = end
+        end = min(length, end + chunk_size)
+    if run_start is not None:
+        runs.append((run_start, length))
+    return runs
+
+
+class _PyBuffer(ctypes.Structure):
+    # Py_buffer from Python's buffer protocol
+    _fields_ = [('buf', ctypes.c_void_p), ('obj', ctypes.py_object), ('len', ctypes.c_ssize_t),
+                ('itemsize', ctypes.c_ssize_t), ('readonly', ctypes.c_int), ('ndim', ctypes.c_int),
+                ('format', ctypes.c_char_p), ('shape', ctypes.c_void_p), ('strides', ctypes.c_void_p),
+                ('suboffsets', ctypes.c_void_p), ('internal', ctypes.c_void_p)]
+
+
+_PyBUF_SIMPLE = 0
+ctypes.pythonapi.PyObject_GetBuffer.argtypes = [ctypes.py_object, ctypes.POINTER(_PyBuffer), ctypes.c_int]
+ctypes.pythonapi.PyObject_GetBuffer.restype = ctypes.c_int
+ctypes.pythonapi.PyBuffer_Release.argtypes = [ctypes.POINTER(_PyBuffer)]
+ctypes.pythonapi.PyBuffer_Release.restype = None
+
+
+class _BufferExport:
+    """
+    Holds on to a buffer, so that its memory stays where it is, until this is garbage collected.
+    """
+
+    def __init__(self, view: memoryview):
+        self._buffer = _PyBuffer()
+        # Raises the Python error if it fails
+        ctypes.pythonapi.PyObject_GetBuffer(view, ctypes.byref(self._buffer), _PyBUF_SIMPLE)
+        self.address = self._buffer.buf or 0
+
+    def __del__(self):
+        ctypes.pythonapi.PyBuffer_Release(ctypes.byref(self._buffer))
+
+
+def buffer_address(view: memoryview) -> tuple[int, object]:
+    """
+    Address of a contiguous buffer, and the object which has to be kept alive while the address is in use.
+
+    ctypes only takes the address of writable buffers. Read-only ones, like the bytes returned by the stock RBD
+    bindings, are exported through the buffer protocol instead of being copied. Nothing may be written to them.
+    """
+    if view.readonly:
+        export = _BufferExport(view)
+        return export.address, export
+    c_buf = (ctypes.c_char * view.nbytes).from_buffer(view)
+    return ctypes.addressof(c_buf), c_buf
+
+
+def nonzero_runs(data, base_offset: int, chunk_size: int) -> list[tuple[int, int]]:
+    """
+    Find the parts of a buffer which are not all zeroes.
+
+    The buffer is split into chunks on chunk_size boundaries of the device, where base_offset is the device offset of
+    the start of the buffer. Returns (start, end) pairs, relative to the buffer, for each run of consecutive chunks
+    which contain any non-zero byte. Each chunk is compared against a zero buffer without copying it.
+    """
+    zero = _zero_chunk(chunk_size)
+    if isinstance(data, (bytes, bytearray)):
+        zero_view = memoryview(zero)
+        return _chunk_runs(len(data), base_offset, chunk_size,
+                           lambda start, end: data.startswith(zero_view[:end - start], start))
+    view = memoryview(data).cast('B')
+    if view.nbytes == 0:
+        return []
+    address, c_buf = buffer_address(view)
+    try:
+        zero_address = ctypes.cast(ctypes.c_char_p(zero), ctypes.c_void_p).value
+        return _chunk_runs(view.nbytes, base_offset, chunk_size,
+                           lambda start, end: _libc.memcmp(address + start, zero_address, end - start) == 0)
+    finally:
+        del c_buf
+
+
+def changed_runs(data, current: bytearray, base_offset: int, chunk_size: int) -> list[tuple[int, int]]:
+    """
+    Like nonzero_runs, but finds the chunks of data which differ from current, a buffer of the same length holding
+    what is on the device now.
+    """
+    current_view = memoryview(current)
+    if isinstance(data, (bytes, bytearray)):
+        return _chunk_runs(len(data), base_offset, chunk_size,
+                           lambda start, end: data.startswith(current_view[start:end], start))
+    view = memoryview(data).cast('B')
+    if view.nbytes == 0:
+        return []
+    address, c_buf = buffer_address(view)
+    current_address, c_current = buffer_address(current_view)
+    try:
+        return _chunk_runs(view.nbytes, base_offset, chunk_size,
+                           lambda start, end: _libc.memcmp(address + start, current_address + start,
+                                                           end - start) == 0)
+    finally:
+        del c_buf, c_current
+
+
+class BufferPool:
+    """
+    A pool of reusable, page-aligned buffers for reading extents into, so that the transfer path does not allocate
+    and free a buffer for every extent.
+
+    Buffers are anonymous mmaps of buffer_size bytes. Up to max_free released buffers are kept for reuse.
+    """
+
+    def __init__(self, buffer_size: int, max_free: int = 64):
+        self.buffer_size = -(-buffer_size // mmap.PAGESIZE) * mmap.PAGESIZE
+        self.max_free = max_free
+        self._free: list[mmap.mmap] = []
+        self._lock = threading.Lock()
+
+    def acquire(self) -> mmap.mmap:
+        with self._lock:
+            if self._free:
+                return self._free.pop()
+        return mmap.mmap(-1, self.buffer_size)
+
+    def release(self, buffer: mmap.mmap):
+        with self._lock:
+            if len(self._free) < self.max_free:
+                self._free.append(buffer)
@@ -0,0 +1,158 @@
+import contextlib
+import threading
+import time
+from typing import Optional
+
+from ceph_to_zfs.statuslogger import Loggable, JobLogger
+
+
+class ConcurrencyLimiter:
+    """
+    A semaphore whose limit can be changed while tasks hold it.
+    """
+
+    def __init__(self, limit: int):
+        if limit < 1:
+            raise ValueError(f'Concurrency limit must be at least 1, got {limit}')
+        self._cond = threading.Condition()
+        self._limit = limit
+        self._active = 0
+
+    @property
+    def limit(self) -> int:
+        return self._limit
+
+    @limit.setter
+    def limit(self, limit: int):
+        with self._cond:
+            self._limit = limit
+            self._cond.notify_all()
+
+    @property
+    def active(self) -> int:
+        return self._active
+
+    def acquire(self):
+        with self._cond:
+            while self._active >= self._limit:
+                self._cond.wait()
+            self._active += 1
+
+    def release(self):
+        with self._cond:
+            self._active -= 1
+            self._cond.notify_all()
+
+    @contextlib.contextmanager
+    def slot(self):
+        self.acquire()
+        try:
+            yield
+        finally:
+            self.release()
+
+
+class AdaptiveConcurrencyLimiter(ConcurrencyLimiter, Loggable):
+    """
+    A ConcurrencyLimiter which tunes its own limit from the throughput and read latency reported via record().
+
+    Every interval seconds, the limit is cut by a quarter if latency has risen above latency_tolerance times the
+    best seen so far, and otherwise goes up by one if throughput did not drop.
+    """
+
+    def __init__(self, status_logger: JobLogger, initial: int, minimum: int = 1, maximum: int = 16,
+                 interval: float = 10.0, latency_tolerance: float = 2.0):
+        ConcurrencyLimiter.__init__(self, max(minimum, min(initial, maximum)))
+        Loggable.__init__(self, status_logger)
+        self.minimum = minimum
+        self.maximum = maximum
+        self.interval = interval
+        self.latency_tolerance = latency_tolerance
+        self._lock = threading.Lock()
+        self._window_start = time.monotonic()
+        self._window_bytes = 0
+        self._window_latencies: list[float] = []
+        self._last_throughput: Optional[float] = None
+        self._best_latency: Optional[float] = None
+
+    def record(self, nbytes: int, mean_latency: float):
+        with self._lock:
+            self._window_bytes += nbytes
+            if mean_latency > 0:
+                self._window_latencies.append(mean_latency)
+            now = time.monotonic()
+            elapsed = now - self._window_start
+            if elapsed < self.interval:
+                return
+            throughput = self._window_bytes / elapsed
+            latency = (sum(self._window_latencies) / len(self._window_latencies)
+                       if self._window_latencies else None)
+            self._window_start = now
+            self._window_bytes = 0
+            self._window_latencies = []
+            self._adjust(throughput, latency)
+
+    def _adjust(self, throughput: float, latency: Optional[float]):
+        old_limit = self.limit
+        if latency is not None and (self._best_latency is None or latency < self._best_latency):
+            self._best_latency = latency
+        if latency is not None and latency > self._best_latency * self.latency_tolerance:
+            new_limit = max(self.minimum, old_limit * 3 // 4)
+            reason = f'latency {latency * 1000:.1f}ms vs best {self._best_latency * 1000:.1f}ms'
+        elif self._last_throughput is None or throughput >= self._last_throughput:
+            new_limit = min(self.maximum, old_limit + 1)
+            reason = f'throughput {throughput / 1024 ** 2:.1f}MiB/s'
+        else:
+            new_limit = old_limit
+            reason = None
+        self._last_throughput = throughput
+        if new_limit != old_limit:
+            self.log(f'Adjusting concurrency from {old_limit} to {new_limit} ({reason})')
+            self.limit = new_limit
+
+
+class ResourceScheduler:
+    """
+    Shares a global worker budget between all jobs and pools, with optional per-cluster and per-zpool limits.
+
+    A slot is only handed out when the global limit and the limits for its cluster and zpool all have room, and all
+    three are taken at once, so a task waiting on a busy cluster never holds a slot that another cluster could use.
+    """
+
+    def __init__(self, max_workers: int, max_workers_per_cluster: Optional[int] = None,
+                 max_workers_per_zpool: Optional[int] = None):
+        self.max_workers = max_workers
+        self.max_workers_per_cluster = max_workers_per_cluster
+        self.max_workers_per_zpool = max_workers_per_zpool
+        self._cond = threading.Condition()
+        self._active = 0
+        self._active_per_cluster: dict[object, int] = {}
+        self._active_per_zpool: dict[str, int] = {}
+
+    def _has_room(self, cluster: object, zpool: str) -> bool:
+        if self._active >= self.max_workers:
+            return False
+        if (self.max_workers_per_cluster is not None
+                and self._active_per_cluster.get(cluster, 0) >= self.max_workers_per_cluster):
+            return False
+        if (self.max_workers_per_zpool is not None
+                and self._active_per_zpool.get(zpool, 0) >= self.max_workers_per_zpool):
+            return False
+        return True
+
+    @contextlib.contextmanager
+    def slot(self, cluster: object, zpool: str):
+        with self._cond:
+            while not self._has_room(cluster, zpool):
+                self._cond.wait()
+            self._active += 1
+            self._active_per_cluster[cluster] = self._active_per_cluster.get(cluster, 0) + 1
+            self._active_per_zpool[zpool] = self._active_per_zpool.get(zpool, 0) + 1
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._active -= 1
+                self._active_per_cluster[cluster] -= 1
+                self._active_per_zpool[zpool] -= 1
+                self._cond.notify_all()
@@ -1,6 +1,8 @@
 import abc
 import dataclasses
+import enum
 import re
+from typing import Optional, Callable
 
 
 class ImageFilter(metaclass=abc.ABCMeta):
@@ -22,6 +24,44 @@ class RegexImagesFilter(ImageFilter):
         return self.pattern.match(image_name) is not None
 
 
+class ImageOrdering(metaclass=abc.ABCMeta):
+    @abc.abstractmethod
+    def order(self, image_names: list[str], predicted_bytes: Callable[[str], int]) -> list[str]:
+        raise NotImplemented
+
+
+class ListedOrdering(ImageOrdering):
+    """
+    Back up images in the order RBD lists them.
+    """
+
+    def order(self, image_names: list[str], predicted_bytes: Callable[[str], int]) -> list[str]:
+        return list(image_names)
+
+
+class LargestFirstOrdering(ImageOrdering):
+    """
+    Back up the images with the most data to transfer first, so that a big image does not start last and hold up
+    the whole pool. The prediction is the bytes read on the previous run, or the size of the zvol or image.
+    """
+
+    def order(self, image_names: list[str], predicted_bytes: Callable[[str], int]) -> list[str]:
+        predictions = {image_name: predicted_bytes(image_name) for image_name in image_names}
+        return sorted(image_names, key=predictions.__getitem__, reverse=True)
+
+
+class DiffMode(enum.Enum):
+    # Use TWO_LEVEL if the image has a valid fast-diff object map, else FINE
+    AUTO = 'auto'
+    # Exact changed extents. librbd has to examine every object of the image.
+    FINE = 'fine'
+    # Whole changed objects, answered from the object map when fast-diff is enabled. Reads and rewrites every
+    # changed object in full. Only used when configured explicitly.
+    WHOLE_OBJECT = 'whole_object'
+    # A whole-object diff to find the changed objects, then an exact diff within only those objects
+    TWO_LEVEL = 'two_level'
+
+
 @dataclasses.dataclass(kw_only=True, frozen=True)
 class CephCluster:
     auth_name: str = 'client.admin'
@@ -34,6 +74,58 @@ class PoolConfig:
     ceph_pool_name: str
     zfs_destination: str
     image_filter: ImageFilter = AllImagesFilter()
+    image_ordering: ImageOrdering = LargestFirstOrdering()
+    # Number of threads reading extents from RBD for each image
+    read_workers: int = 4
+    # Maximum number of extents queued or in flight for each image
+    queue_depth: int = 64
+    # Maximum number of bytes of extent data held in memory for each image
+    max_bytes_in_flight: int = 256 * 1024 * 1024
+    # Read with librbd's asynchronous API instead of reader threads, keeping up to queue_depth reads in flight
+    aio_reads: bool = False
+    # Write to the zvol with O_DIRECT, bypassing the page cache
+    direct_io: bool = False
+    # Submit zvol writes in batches with io_uring, if the kernel allows it. Takes precedence over direct_io.
+    io_uring: bool = False
+    # Discard extents which no longer exist in RBD instead of reading zeroes from the cluster and writing them
+    discard_zero_extents: bool = True
+    # When a full backup creates a new zvol, skip writing blocks which are all zeroes, leaving them sparse
+    skip_zeroes_on_new_zvol: bool = True
+    # Read back each volblocksize block of an existing zvol before writing it, and skip blocks which already hold
+    # the same data. Rewriting identical data still allocates new blocks in ZFS and makes snapshots bigger.
+    compare_before_write: bool = False
+    # Keep a file of block hashes for each zvol in this directory, and skip writing blocks whose hash has not
+    # changed, without reading anything back from the zvol. Takes precedence over compare_before_write.
+    block_hash_index_dir: Optional[str] = None
+    # Split large images into up to this many ranges, each transferred in parallel with its own image handle
+    shards_per_image: int = 1
+    # Images are not split into shards smaller than this
+    min_shard_size: int = 64 * 1024 ** 3
+    # Number of images backed up at the same time. Defaults to the job's image_workers.
+    image_workers: Optional[int] = None
+    # Tune the number of concurrent images between 1 and max_image_workers based on throughput and read latency,
+    # starting from image_workers
+    adaptive_image_workers: bool = False
+    max_image_workers: int = 16
+    # Before backing anything up, run a diff of every image to estimate how much data will be transferred. This
+    # is used for progress/ETA reporting and by image_ordering.
+    plan_before_backup: bool = False
+    # Use whole-object diffs for the estimate, instead of the diff mode the backup will use. Can be faster, but
+    # rounds every change up to a whole object.
+    plan_whole_object: bool = False
+    diff_mode: DiffMode = DiffMode.AUTO
+    # How long to wait for udev to create a new zvol's device node and make it writable
+    device_timeout: float = 60.0
+    # Snapshot zvols of images which finish around the same time together, in one ZFS transaction. A batch is
+    # created once it has snapshot_batch_size snapshots, or snapshot_batch_delay seconds after the first one.
+    batch_snapshots: bool = False
+    snapshot_batch_size: int = 32
+    snapshot_batch_delay: float = 2.0
+    # Round changed extents out to the zvol's volblocksize, so ZFS does not have to read-modify-write partial blocks
+    align_to_volblocksize: bool = True
+    # Merge changed extents which are at most this many bytes apart into one read and write. The unchanged data in
+    # between is read again and rewritten, see compare_before_write. 0 only merges extents which touch.
+    coalesce_gap: int = 0
 
 
 # TODO: not implemented yet
@@ -48,3 +140,17 @@ class Job:
     name: str
     cluster: CephCluster
     pools: list[PoolConfig]
+    # Default number of images backed up at the same time, for pools which do not set their own
+    image_workers: int = 2
+
+
+@dataclasses.dataclass(kw_only=True, frozen=True)
+class SchedulerConfig:
+    # Maximum number of images being backed up at once, across all jobs and pools
+    max_image_workers: int = 8
+    # Optional limits on the number of images being backed up at once from one Ceph cluster, or into one zpool
+    max_image_workers_per_cluster: Optional[int] = None
+    max_image_workers_per_zpool: Optional[int] = None
+    # Run jobs, and the pools within a job, at the same time rather than one after another
+    parallel_jobs: bool = True
+    parallel_pools: bool = True
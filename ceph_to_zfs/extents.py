@@ -0,0 +1,97 @@
+from typing import Callable, Optional
+
+
+class ExtentCoalescer:
+    """
+    Merges the extents reported by diff_iterate before they are submitted, so that many small changes turn into
+    fewer, larger reads and writes.
+
+    Extents with data are rounded out to block_size and clamped to the image size, then merged when the gap
+    between them is at most max_gap bytes and the result is no longer than max_length. Extents which no longer
+    exist are held back until no later data can be rounded over them, and are only merged when they touch.
+
+    Extents must be reported in increasing offset order. Call flush() after the last one.
+    """
+
+    def __init__(self, submit: Callable[[int, int, bool], None], *, image_size: int, block_size: int = 1,
+                 max_gap: int = 0, max_length: Optional[int] = None):
+        self._submit = submit
+        self.image_size = image_size
+        self.block_size = max(block_size, 1)
+        self.max_gap = max_gap
+        self.max_length = max_length
+        # [offset, end] of the data extent which is still being extended
+        self._pending: Optional[list] = None
+        # [offset, end] of the extents which no longer exist and have not been submitted yet, in offset order
+        self._holes: list[list] = []
+        # End of the data submitted so far, including the pending extent
+        self._data_end = 0
+        # End of the last extent which no longer exists that was submitted. Data is not merged across it.
+        self._hole_end = 0
+
+    def __call__(self, offset: int, length: int, exists: bool):
+        if length <= 0:
+            return
+        end = offset + length
+        if exists:
+            offset = offset // self.block_size * self.block_size
+            end = max(min(-(-end // self.block_size) * self.block_size, self.image_size), end)
+        offset = max(offset, self._data_end)
+        if offset >= end:
+            return
+        if exists:
+            self._add_data(offset, end)
+        else:
+            self._add_hole(offset, end)
+
+    def _add_data(self, offset: int, end: int):
+        pending = self._pending
+        self._data_end = end
+        if (pending is not None and offset - pending[1] <= self.max_gap and self._hole_end <= pending[1]
+                and (self.max_length is None or end - pending[0] <= self.max_length)):
+            pending[1] = end
+            offset = pending[0]
+        else:
+            self._flush_data()
+            self._pending = [offset, end]
+        # Data is read up to here, and reads back as zeroes in the holes it covers. Later data starts after it, so
+        # the holes before it are final.
+        while self._holes and self._holes[-1][1] > offset:
+            hole = self._holes[-1]
+            hole[1] = max(offset, hole[0])
+            if hole[0] == hole[1]:
+                self._holes.pop()
+        self._flush_holes()
+
+    def _add_hole(self, offset: int, end: int):
+        holes = self._holes
+        if holes and offset <= holes[-1][1]:
+            holes[-1][1] = max(holes[-1][1], end)
+            return
+        # Later data may be rounded back to the start of this hole's block, but no further
+        block_start = offset // self.block_size * self.block_size
+        while holes and holes[0][1] <= block_start:
+            self._submit_hole(*holes.pop(0))
+        holes.append([offset, end])
+
+    def _submit_hole(self, offset: int, end: int):
+        self._hole_end = end
+        self._submit(offset, end - offset, False)
+
+    def _flush_data(self):
+        if self._pending is not None:
+            offset, end = self._pending
+            self._pending = None
+            self._submit(offset, end - offset, True)
+
+    def _flush_holes(self):
+        for offset, end in self._holes:
+            self._submit_hole(offset, end)
+        self._holes = []
+
+    def flush(self):
+        """
+        Submit the extents which are still being held back, if any.
+        """
+        self._flush_data()
+        self._flush_holes()
@@ -0,0 +1,183 @@
+import hashlib
+import mmap
+import os
+import struct
+import urllib.parse
+from typing import Optional
+
+_MAGIC = b'CTZHASH1'
+# magic, block size, number of blocks, guid of the snapshot the hashes describe (0 if they don't describe one)
+_HEADER = struct.Struct('<8sQQQ')
+# Hashes start here, so that they are 8-byte aligned
+_HEADER_SIZE = 64
+# Hash value meaning "we don't know what is in this block"
+UNKNOWN = 0
+
+
+def block_hash(data) -> int:
+    """
+    64-bit hash of one block. Never returns UNKNOWN.
+    """
+    return int.from_bytes(hashlib.blake2b(data, digest_size=8).digest(), 'little') or 1
+
+
+class BlockHashIndex:
+    """
+    A file holding a 64-bit hash for every volblocksize block of a zvol, so that blocks which are already on the
+    zvol can be skipped without reading anything back from it.
+
+    The hashes describe the zvol as of the snapshot whose guid is in the header. The guid is cleared with
+    mark_dirty() while a backup runs, and set with mark_clean() once its snapshot has been taken.
+    """
+
+    def __init__(self, path: str, block_size: int, size: int):
+        self.path = path
+        self.block_size = block_size
+        block_count = -(-size // block_size)
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            header = os.pread(self._fd, _HEADER.size, 0)
+            if len(header) == _HEADER.size:
+                magic, old_block_size, _, guid = _HEADER.unpack(header)
+            else:
+                magic, old_block_size, guid = None, 0, 0
+            if magic != _MAGIC or old_block_size != block_size:
+                # Unusable, start from scratch
+                os.ftruncate(self._fd, 0)
+                guid = 0
+            # Growing the file adds UNKNOWN hashes for the new blocks
+            os.ftruncate(self._fd, _HEADER_SIZE + block_count * 8)
+            self._map = mmap.mmap(self._fd, _HEADER_SIZE + block_count * 8)
+        except Exception:
+            os.close(self._fd)
+            raise
+        self.block_count = block_count
+        self._zero_hash = block_hash(bytes(block_size))
+        self._hashes = memoryview(self._map)[_HEADER_SIZE:].cast('Q')
+        self._write_header(guid)
+
+    @classmethod
+    def for_dataset(cls, directory: str, zfs_path: str, block_size: int, size: int) -> 'BlockHashIndex':
+        os.makedirs(directory, exist_ok=True)
+        return cls(os.path.join(directory, urllib.parse.quote(zfs_path, safe='') + '.hashes'), block_size, size)
+
+    @property
+    def snapshot_guid(self) -> int:
+        return _HEADER.unpack_from(self._map)[3]
+
+    def _write_header(self, guid: int):
+        _HEADER.pack_into(self._map, 0, _MAGIC, self.block_size, self.block_count, guid)
+
+    def valid_for(self, snapshot_guid: Optional[int]) -> bool:
+        return snapshot_guid is not None and snapshot_guid != 0 and self.snapshot_guid == snapshot_guid
+
+    def reset(self):
+        """
+        Forget every hash.
+
+        The hashes are cut off the file and it is grown back sparse, rather than writing zeroes over all of them.
+        The mapping stays valid, and reads the new UNKNOWN hashes.
+        """
+        self._write_header(0)
+        os.ftruncate(self._fd, _HEADER_SIZE)
+        os.ftruncate(self._fd, len(self._map))
+
+    def mark_dirty(self):
+        """
+        Record that the zvol is being written, and no longer matches any snapshot.
+        """
+        self._write_header(0)
+        self._map.flush()
+
+    def mark_clean(self, snapshot_guid: int):
+        """
+        Record that the hashes now describe the zvol as of the given snapshot.
+        """
+        self._map.flush()
+        self._write_header(snapshot_guid)
+        self._map.flush()
+
+    def _blocks(self, length: int, base_offset: int):
+        """
+        Yield (start, end, block) for each block-sized chunk of a buffer at base_offset, where block is None for
+        chunks which don't cover a whole block.
+        """
+        start = 0
+        end = min(length, self.block_size - base_offset % self.block_size)
+        while start < length:
+            block = (base_offset + start) // self.block_size
+            yield start, end, block if end - start == self.block_size and block < self.block_count else None
+            start = end
+            end = min(length, end + self.block_size)
+
+    def changed_runs(self, data, base_offset: int) -> list[tuple[int, int]]:
+        """
+        Find the parts of data, which is about to be written at base_offset, that differ from the indexed hashes,
+        and record the hashes of the new data. Like buffers.nonzero_runs, returns (start, end) pairs relative to
+        the buffer. Chunks which don't cover a whole block are always treated as changed.
+        """
+        view = memoryview(data).cast('B')
+        hashes = self._hashes
+        runs: list[tuple[int, int]] = []
+        run_start = None
+        for start, end, block in self._blocks(view.nbytes, base_offset):
+            if block is None:
+                unchanged = False
+            else:
+                new_hash = block_hash(view[start:end])
+                unchanged = hashes[block] == new_hash
+                hashes[block] = new_hash
+            if unchanged:
+                if run_start is not None:
+                    runs.append((run_start, start))
+                    run_start = None
+            else:
+                if block is None:
+                    self.forget(base_offset + start, end - start)
+                if run_start is None:
+                    run_start = start
+        if run_start is not None:
+            runs.append((run_start, view.nbytes))
+        return runs
+
+    def update(self, data, base_offset: int):
+        """
+        Record the hashes of data which is being written at base_offset without looking at the old ones.
+        """
+        view = memoryview(data).cast('B')
+        for start, end, block in self._blocks(view.nbytes, base_offset):
+            if block is None:
+                self.forget(base_offset + start, end - start)
+            else:
+                self._hashes[block] = block_hash(view[start:end])
+
+    def zeroed(self, offset: int, length: int):
+        """
+        Record that a range was zeroed, e.g. by a discard.
+        """
+        for start, end, block in self._blocks(length, offset):
+            if block is None:
+                self.forget(offset + start, end - start)
+            else:
+                self._hashes[block] = self._zero_hash
+
+    def forget(self, offset: int, length: int):
+        """
+        Mark the blocks overlapping a range as unknown.
+        """
+        first = offset // self.block_size
+        last = min(-(-(offset + length) // self.block_size), self.block_count)
+        for block in range(first, last):
+            self._hashes[block] = UNKNOWN
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type_, value, traceback):
+        self.close()
+        return False
+
+    def close(self):
+        self._hashes.release()
+        self._map.close()
+        os.close(self._fd)
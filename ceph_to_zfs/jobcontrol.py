@@ -1,10 +1,13 @@
 import importlib.util
 import importlib.util
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
 
 import libzfs
 
 from ceph_to_zfs.backup import PoolBackupController
-from ceph_to_zfs.configuration_options import Job, PoolConfig
+from ceph_to_zfs.concurrency import ResourceScheduler
+from ceph_to_zfs.configuration_options import Job, PoolConfig, SchedulerConfig
 from ceph_to_zfs.statuslogger import *
 from ceph_to_zfs.zfs_support import ZfsContext
 
@@ -22,9 +25,12 @@ z = libzfs.ZFS()
 
 class JobControl:
 
-    def __init__(self, job: Job, job_logger: JobLogger):
+    def __init__(self, job: Job, job_logger: JobLogger, scheduler: Optional[ResourceScheduler] = None,
+                 parallel_pools: bool = False):
         self.job = job
         self.job_logger = job_logger
+        self.scheduler = scheduler
+        self.parallel_pools = parallel_pools
 
     def run(self):
         job_logger = self.job_logger
@@ -36,29 +42,55 @@ class JobControl:
             with rados.Rados(name=cc.auth_name, conffile=cc.conf_file, clustername=cc.cluster_name) as cluster:
                 job_logger.log_status('In progress')
                 pools: list[PoolConfig] = job.pools
-                # TODO: parallelize
-                for pool in pools:
-                    pool_logger = job_logger.make_or_replace_child(pool.ceph_pool_name, True)
-                    pool_logger.log_status('Starting pool backup', In_Progress)
-                    with cluster.open_ioctx(pool.ceph_pool_name) as ctx:
-                        pool_logger.status_text = 'In progress'
-                        # img_name = img.get_name()
-                        zc = ZfsContext(pool_logger, z.get_dataset(pool.zfs_destination))
-                        bc = PoolBackupController(pool_logger, ctx, zc, pool.image_filter)
-                        bc.backup_all_images()
-                        pool_logger.status_text = 'Complete'
-                        pool_logger.status_type = Success
+                if self.parallel_pools and len(pools) > 1:
+                    with ThreadPoolExecutor(max_workers=len(pools)) as executor:
+                        futures = [executor.submit(self.run_pool, cluster, pool) for pool in pools]
+                    # Raises the first pool failure, if any
+                    for future in futures:
+                        future.result()
+                else:
+                    for pool in pools:
+                        self.run_pool(cluster, pool)
                 job_logger.status_text = 'Complete'
                 job_logger.status_type = Success
         except Exception as e:
             job_logger.log(f'Failure: {e}')
             job_logger.log_status(f'Failed! {e}', status_type=Failed)
 
+    def run_pool(self, cluster: rados.Rados, pool: PoolConfig):
+        job = self.job
+        pool_logger = self.job_logger.make_or_replace_child(pool.ceph_pool_name, True)
+        pool_logger.log_status('Starting pool backup', In_Progress)
+        try:
+            with cluster.open_ioctx(pool.ceph_pool_name) as ctx:
+                pool_logger.status_text = 'In progress'
+                # img_name = img.get_name()
+                zc = ZfsContext(pool_logger, z.get_dataset(pool.zfs_destination), z)
+                if self.scheduler is not None:
+                    zpool = pool.zfs_destination.split('/')[0]
+                    scheduler = self.scheduler
+
+                    def scheduler_slot():
+                        return scheduler.slot(job.cluster, zpool)
+                else:
+                    scheduler_slot = None
+                bc = PoolBackupController(pool_logger, ctx, zc, pool, job.image_workers, scheduler_slot)
+                bc.backup_all_images()
+                pool_logger.status_text = 'Complete'
+                pool_logger.status_type = Success
+        except Exception as e:
+            pool_logger.log_status(f'Failed! {e}', status_type=Failed)
+            raise
+
 
 class GlobalControl:
 
     def __init__(self, logger: TopLevelLogger, config):
         self.logger = logger
+        self.scheduler_config: SchedulerConfig = getattr(config, 'scheduler', SchedulerConfig())
+        self.scheduler = ResourceScheduler(self.scheduler_config.max_image_workers,
+                                           self.scheduler_config.max_image_workers_per_cluster,
+                                           self.scheduler_config.max_image_workers_per_zpool)
         self.jobs: list[JobControl] = [self._make_or_replace_child(job) for job in config.jobs]
         logger.log_status('Ready to run jobs', status_type=Not_Started)
 
@@ -78,11 +110,16 @@ class GlobalControl:
 
     def run_all_jobs(self):
         jobs = self.jobs
-        # TODO: parallelize
         try:
             self.logger.log_status('Running jobs', status_type=In_Progress)
-            for job in jobs:
-                job.run()
+            if self.scheduler_config.parallel_jobs and len(jobs) > 1:
+                # JobControl.run() handles its own errors, so there is nothing to collect from the futures
+                with ThreadPoolExecutor(max_workers=len(jobs)) as executor:
+                    for job in jobs:
+                        executor.submit(job.run)
+            else:
+                for job in jobs:
+                    job.run()
             self.logger.log_status('Complete', status_type=Success)
         except Exception as e:
             self.logger.log(f"Error! {e}")
@@ -90,5 +127,5 @@ class GlobalControl:
 
     def _make_or_replace_child(self, job: Job) -> JobControl:
         job_logger = self.logger.make_or_replace_child(job.name, False)
-        jc = JobControl(job, job_logger)
+        jc = JobControl(job, job_logger, self.scheduler, self.scheduler_config.parallel_pools)
         return jc
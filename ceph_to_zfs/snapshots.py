@@ -0,0 +1,157 @@
+import ctypes
+import ctypes.util
+import os
+import threading
+import time
+from typing import Optional
+
+from ceph_to_zfs.statuslogger import Loggable, JobLogger
+from ceph_to_zfs.zfs_support import ZfsDatasetContext
+
+# From sys/nvpair.h
+NV_UNIQUE_NAME = 0x1
+
+_libs: Optional[tuple[ctypes.CDLL, ctypes.CDLL]] = None
+# Remembered so that every batch does not search for the libraries again
+_load_error: Optional[OSError] = None
+_libs_lock = threading.Lock()
+
+
+def _load_lzc() -> tuple[ctypes.CDLL, ctypes.CDLL]:
+    """
+    Load and initialize libzfs_core and libnvpair. Only done once; raises OSError if they are not available.
+    """
+    global _libs, _load_error
+    with _libs_lock:
+        if _load_error is not None:
+            raise _load_error
+        if _libs is None:
+            try:
+                _libs = _init_lzc()
+            except OSError as e:
+                _load_error = e
+                raise
+        return _libs
+
+
+def _init_lzc() -> tuple[ctypes.CDLL, ctypes.CDLL]:
+    lzc_path = ctypes.util.find_library('zfs_core')
+    nvpair_path = ctypes.util.find_library('nvpair')
+    if not lzc_path or not nvpair_path:
+        raise OSError('libzfs_core or libnvpair not found')
+    lzc = ctypes.CDLL(lzc_path)
+    nvpair = ctypes.CDLL(nvpair_path)
+    nvpair.nvlist_alloc.argtypes = [ctypes.POINTER(ctypes.c_void_p), ctypes.c_uint, ctypes.c_int]
+    nvpair.nvlist_alloc.restype = ctypes.c_int
+    nvpair.nvlist_add_boolean.argtypes = [ctypes.c_void_p, ctypes.c_char_p]
+    nvpair.nvlist_add_boolean.restype = ctypes.c_int
+    nvpair.nvlist_free.argtypes = [ctypes.c_void_p]
+    nvpair.nvlist_free.restype = None
+    lzc.lzc_snapshot.argtypes = [ctypes.c_void_p, ctypes.c_void_p, ctypes.POINTER(ctypes.c_void_p)]
+    lzc.lzc_snapshot.restype = ctypes.c_int
+    ret = lzc.libzfs_core_init()
+    if ret != 0:
+        raise OSError(ret, f'libzfs_core_init failed: {os.strerror(ret)}')
+    return lzc, nvpair
+
+
+def lzc_snapshot(paths: list[str]):
+    """
+    Create several snapshots ('dataset@name'), which must all be in the same zpool, atomically in one transaction
+    group with lzc_snapshot(). Either all of them are created, or none are.
+    """
+    lzc, nvpair = _load_lzc()
+    snaps = ctypes.c_void_p()
+    ret = nvpair.nvlist_alloc(ctypes.byref(snaps), NV_UNIQUE_NAME, 0)
+    if ret != 0:
+        raise OSError(ret, os.strerror(ret))
+    try:
+        for path in paths:
+            ret = nvpair.nvlist_add_boolean(snaps, path.encode())
+            if ret != 0:
+                raise OSError(ret, os.strerror(ret))
+        errors = ctypes.c_void_p()
+        ret = lzc.lzc_snapshot(snaps, None, ctypes.byref(errors))
+        if errors:
+            nvpair.nvlist_free(errors)
+        if ret != 0:
+            raise OSError(ret, f'lzc_snapshot failed: {os.strerror(ret)}')
+    finally:
+        nvpair.nvlist_free(snaps)
+
+
+class _SnapshotRequest:
+    def __init__(self, zfs_dest: ZfsDatasetContext, name: str):
+        self.zfs_dest = zfs_dest
+        self.name = name
+        self.done = False
+        self.error: Optional[Exception] = None
+
+    @property
+    def path(self) -> str:
+        return self.zfs_dest.zfs_path + '@' + self.name
+
+
+class SnapshotBatcher(Loggable):
+    """
+    Creates the snapshots of images which finished around the same time with a single lzc_snapshot() call.
+
+    create_snapshot() blocks until the caller's snapshot exists. A batch is created once it holds max_batch
+    snapshots, or max_delay seconds after its first snapshot was requested. If that fails, each snapshot is created
+    separately instead.
+    """
+
+    def __init__(self, status_logger: JobLogger, max_batch: int = 32, max_delay: float = 2.0):
+        super().__init__(status_logger)
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self._cond = threading.Condition()
+        self._pending: list[_SnapshotRequest] = []
+        self._deadline: Optional[float] = None
+
+    def create_snapshot(self, zfs_dest: ZfsDatasetContext, name: str):
+        request = _SnapshotRequest(zfs_dest, name)
+        with self._cond:
+            self._pending.append(request)
+            if self._deadline is None:
+                self._deadline = time.monotonic() + self.max_delay
+            self._cond.notify_all()
+        while True:
+            batch = None
+            with self._cond:
+                while not request.done and batch is None:
+                    if self._pending and (len(self._pending) >= self.max_batch
+                                          or time.monotonic() >= self._deadline):
+                        batch, self._pending, self._deadline = self._pending, [], None
+                    elif self._deadline is not None:
+                        self._cond.wait(self._deadline - time.monotonic())
+                    else:
+                        # Our snapshot is in a batch someone else is creating
+                        self._cond.wait()
+            if batch is None:
+                break
+            self._create(batch)
+        if request.error is not None:
+            raise request.error
+
+    def _create(self, batch: list[_SnapshotRequest]):
+        try:
+            lzc_snapshot([request.path for request in batch])
+            self.log(f'Created {len(batch)} snapshot(s) in one transaction')
+        except OSError as e:
+            self.log(f'Could not create {len(batch)} snapshot(s) at once, creating them one by one: {e}')
+            for request in batch:
+                try:
+                    request.zfs_dest.create_snapshot(request.name)
+                except Exception as create_error:
+                    request.error = create_error
+        except Exception as e:
+            # Don't let anyone carry on as if their snapshot exists
+            for request in batch:
+                request.error = e
+        finally:
+            with self._cond:
+                for request in batch:
+                    request.zfs_dest.invalidate_snapshots()
+                    request.done = True
+                self._cond.notify_all()
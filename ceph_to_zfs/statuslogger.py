@@ -1,8 +1,10 @@
 from __future__ import annotations
 
 import datetime
+import threading
+import time
 from collections import OrderedDict
-from typing import Callable
+from typing import Callable, Optional
 
 
 class TaskStatus:
@@ -54,6 +56,11 @@ class JobLogger:
         self.messages: list[str] = []
         self._children: OrderedDict[str, JobLogger] = OrderedDict()
         self._status_text: str = self._status_type.label
+        # Progress of the data transfer for this task, see set_expected_bytes() and add_transferred_bytes()
+        self._expected_bytes: Optional[int] = None
+        self._transferred_bytes: int = 0
+        self._transfer_started: Optional[float] = None
+        self._progress_lock = threading.Lock()
         if log_func is None:
             if parent is None:
                 raise ValueError('Either parent or log_func must be specified')
@@ -122,6 +129,50 @@ class JobLogger:
         self._status_type = status_type
 
 
+    def set_expected_bytes(self, expected_bytes: Optional[int]):
+        self._expected_bytes = expected_bytes
+
+    def add_transferred_bytes(self, count: int):
+        with self._progress_lock:
+            if self._transfer_started is None:
+                self._transfer_started = time.monotonic()
+            self._transferred_bytes += count
+
+    @property
+    def expected_bytes(self) -> Optional[int]:
+        """
+        Bytes this task and its sub-tasks are expected to transfer, or None if nothing has been estimated.
+        """
+        totals = [child.expected_bytes for child in self.children.values()]
+        totals.append(self._expected_bytes)
+        known = [total for total in totals if total is not None]
+        return sum(known) if known else None
+
+    @property
+    def transferred_bytes(self) -> int:
+        return self._transferred_bytes + sum(child.transferred_bytes for child in self.children.values())
+
+    @property
+    def transfer_started(self) -> Optional[float]:
+        starts = [child.transfer_started for child in self.children.values()]
+        starts.append(self._transfer_started)
+        known = [start for start in starts if start is not None]
+        return min(known) if known else None
+
+    @property
+    def eta_seconds(self) -> Optional[float]:
+        """
+        Estimated seconds until the transfer finishes, based on the average rate so far.
+        """
+        expected = self.expected_bytes
+        started = self.transfer_started
+        transferred = self.transferred_bytes
+        if expected is None or started is None or transferred <= 0 or self.status_type.is_terminal:
+            return None
+        elapsed = time.monotonic() - started
+        return max(expected - transferred, 0) * elapsed / transferred
+
+
 class TopLevelLogger(JobLogger):
     def __init__(self, name: str):
         super().__init__(name=name)
@@ -0,0 +1,337 @@
+import dataclasses
+import queue
+import threading
+import time
+from typing import Callable, Optional
+
+from ceph_to_zfs.buffers import nonzero_runs, changed_runs, BufferPool
+from ceph_to_zfs.hashindex import BlockHashIndex
+from ceph_to_zfs.statuslogger import Loggable, JobLogger
+from ceph_to_zfs.writers import DeviceWriter
+
+# Tells a worker thread to exit
+_STOP = None
+
+# Most extents the writer picks up from its queue at once
+_WRITE_BATCH = 64
+
+
+class TransferFailed(Exception):
+    pass
+
+
+@dataclasses.dataclass
+class TransferStats:
+    # Bytes reported by diff_iterate
+    requested: int = 0
+    # Bytes which made it to the device, including discards
+    written: int = 0
+    # Bytes zeroed with a discard rather than written
+    discarded: int = 0
+    # Zero bytes which did not need to be written at all
+    skipped: int = 0
+    # Bytes which were not written because the device already held the same data
+    unchanged: int = 0
+    # Number of RBD reads, the bytes they returned, and the total time spent waiting on them
+    reads: int = 0
+    read_bytes: int = 0
+    read_seconds: float = 0.0
+
+    @property
+    def mean_read_latency(self) -> float:
+        return self.read_seconds / self.reads if self.reads else 0.0
+
+    def __add__(self, other: 'TransferStats') -> 'TransferStats':
+        return TransferStats(**{field.name: getattr(self, field.name) + getattr(other, field.name)
+                                for field in dataclasses.fields(self)})
+
+
+class TransferPipeline(Loggable):
+    """
+    Copies extents from an RBD image to a block device. Reader threads (or aio reads, with aio_image) fetch extents
+    while a single writer thread writes them, and submit() blocks once queue_depth or max_bytes_in_flight is used up.
+
+    Optional modes: discard_block_size discards non-existent extents instead of reading them, zero_chunk_size skips
+    all-zero chunks on a new device, and compare_chunk_size or hash_index skip chunks the device already holds.
+    """
+
+    def __init__(self, status_logger: JobLogger, read_func: Callable[[int, int], bytes], device: DeviceWriter, *,
+                 read_workers: int, queue_depth: int, max_bytes_in_flight: int,
+                 discard_block_size: Optional[int] = None, zero_chunk_size: Optional[int] = None,
+                 compare_chunk_size: Optional[int] = None, hash_index: Optional[BlockHashIndex] = None,
+                 readinto_func: Optional[Callable[[memoryview, int], int]] = None,
+                 buffer_pool: Optional[BufferPool] = None, aio_image=None):
+        super().__init__(status_logger)
+        if read_workers < 1:
+            raise ValueError(f'read_workers must be at least 1, got {read_workers}')
+        if queue_depth < 1:
+            raise ValueError(f'queue_depth must be at least 1, got {queue_depth}')
+        self._read_func = read_func
+        self._readinto_func = readinto_func if buffer_pool is not None else None
+        self._buffer_pool = buffer_pool
+        self._aio_image = aio_image
+        self._aio_outstanding = 0
+        self._device = device
+        self.queue_depth = queue_depth
+        self.max_bytes_in_flight = max_bytes_in_flight
+        self.discard_block_size = discard_block_size
+        self.zero_chunk_size = zero_chunk_size
+        self.compare_chunk_size = compare_chunk_size
+        self.hash_index = hash_index
+        self._read_queue: queue.Queue = queue.Queue()
+        self._write_queue: queue.Queue = queue.Queue()
+        self._budget = threading.Condition()
+        self._extents_in_flight = 0
+        self._bytes_in_flight = 0
+        self._stats_lock = threading.Lock()
+        self.stats = TransferStats()
+        self.failures: list[Exception] = []
+        if aio_image is None:
+            self._readers = [threading.Thread(target=self._reader_loop, name=f'ctz-reader-{i}', daemon=True)
+                             for i in range(read_workers)]
+        else:
+            self._readers = []
+        self._writer = threading.Thread(target=self._writer_loop, name='ctz-writer', daemon=True)
+        self._started = False
+        self._finished = False
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, type_, value, traceback):
+        self.finish()
+        return False
+
+    def start(self):
+        for thread in self._readers:
+            thread.start()
+        self._writer.start()
+        self._started = True
+
+    def submit(self, offset: int, length: int, exists: bool):
+        """
+        Queue an extent for transfer. Blocks until there is room in the queue.
+
+        Raises TransferFailed if an earlier extent failed, so that diff_iterate stops early.
+        """
+        if not self._started:
+            raise RuntimeError('TransferPipeline.submit() called before start()')
+        if not exists and self.zero_chunk_size is not None:
+            with self._stats_lock:
+                self.stats.requested += length
+                self.stats.skipped += length
+            if self.hash_index is not None:
+                self.hash_index.zeroed(offset, length)
+            return
+        # Discarded extents never hold data in memory, so they only count against the queue depth
+        discard = self._discards(exists)
+        buffered = 0 if discard else length
+        with self._budget:
+            # A single extent larger than the whole byte budget is still allowed through on its own
+            while (not self.failures and self._extents_in_flight > 0
+                   and (self._extents_in_flight >= self.queue_depth
+                        or self._bytes_in_flight + buffered > self.max_bytes_in_flight)):
+                self._budget.wait()
+            if self.failures:
+                raise TransferFailed(f'Not queueing extent at {offset}: {len(self.failures)} earlier failure(s)')
+            self._extents_in_flight += 1
+            self._bytes_in_flight += buffered
+        with self._stats_lock:
+            self.stats.requested += length
+        if discard:
+            self._write_queue.put((offset, length, exists, None, None))
+        elif self._aio_image is not None:
+            self._start_aio_read(offset, length, exists)
+        else:
+            self._read_queue.put((offset, length, exists))
+
+    def finish(self):
+        """
+        Wait for all queued extents to be written, then stop the worker threads.
+        """
+        if self._finished or not self._started:
+            return
+        self._finished = True
+        for _ in self._readers:
+            self._read_queue.put(_STOP)
+        for thread in self._readers:
+            thread.join()
+        with self._budget:
+            while self._aio_outstanding:
+                self._budget.wait()
+        self._write_queue.put(_STOP)
+        self._writer.join()
+
+    def _discards(self, exists: bool) -> bool:
+        return not exists and self.discard_block_size is not None
+
+    def _release(self, buffered: int, buffer=None):
+        if buffer is not None:
+            self._buffer_pool.release(buffer)
+        with self._budget:
+            self._extents_in_flight -= 1
+            self._bytes_in_flight -= buffered
+            self._budget.notify_all()
+
+    def _fail(self, e: Exception, offset: int, length: int, exists: bool, action: str):
+        self.log(f'FAILED {action} - {length} bytes from {offset} to {offset + length - 1} (exists: {exists})\n{e}')
+        with self._budget:
+            self.failures.append(e)
+            self._budget.notify_all()
+
+    def _reader_loop(self):
+        while True:
+            item = self._read_queue.get()
+            if item is _STOP:
+                return
+            offset, length, exists = item
+            if self.failures:
+                self._release(length)
+                continue
+            buffer = None
+            try:
+                read_start = time.monotonic()
+                if self._readinto_func is not None and length <= self._buffer_pool.buffer_size:
+                    buffer = self._buffer_pool.acquire()
+                    data = memoryview(buffer)[:length]
+                    count = self._readinto_func(data, offset)
+                else:
+                    data = self._read_func(offset, length)
+                    count = len(data)
+                self._read_done(offset, length, count, time.monotonic() - read_start)
+            except Exception as e:
+                self._fail(e, offset, length, exists, 'READ')
+                self._release(length, buffer)
+                continue
+            self._write_queue.put((offset, length, exists, data, buffer))
+
+    def _read_done(self, offset: int, length: int, count: int, read_seconds: float):
+        if count < 0:
+            raise TransferFailed(f'Read failed with error code {count}')
+        if count != length:
+            raise TransferFailed(f'Short read: got {count} of {length} bytes')
+        with self._stats_lock:
+            self.stats.reads += 1
+            self.stats.read_bytes += length
+            self.stats.read_seconds += read_seconds
+        self.logger.add_transferred_bytes(length)
+
+    def _start_aio_read(self, offset: int, length: int, exists: bool):
+        image = self._aio_image
+        buffer = None
+        read_start = time.monotonic()
+
+        # Runs on a librbd thread, so it must not raise
+        def on_read(completion, data):
+            try:
+                count = completion.get_return_value()
+                if data is None and count >= 0:
+                    raise TransferFailed('Read completed without data')
+                self._read_done(offset, length, count, time.monotonic() - read_start)
+            except Exception as e:
+                self._fail(e, offset, length, exists, 'READ')
+                self._release(length, buffer)
+            else:
+                self._write_queue.put((offset, length, exists, data, buffer))
+            finally:
+                with self._budget:
+                    self._aio_outstanding -= 1
+                    self._budget.notify_all()
+
+        with self._budget:
+            self._aio_outstanding += 1
+        try:
+            if self._buffer_pool is not None and hasattr(image, 'aio_readinto') \
+                    and length <= self._buffer_pool.buffer_size:
+                buffer = self._buffer_pool.acquire()
+                image.aio_readinto(memoryview(buffer)[:length], offset, on_read)
+            else:
+                image.aio_read(offset, length, on_read)
+        except Exception as e:
+            self._fail(e, offset, length, exists, 'READ')
+            self._release(length, buffer)
+            with self._budget:
+                self._aio_outstanding -= 1
+                self._budget.notify_all()
+
+    def _write_batch(self, items: list[tuple]):
+        extents = []
+        written = 0
+        unchanged = 0
+        try:
+            for offset, length, exists, data, buffer in items:
+                runs = None
+                if self.zero_chunk_size is not None:
+                    runs = nonzero_runs(data, offset, self.zero_chunk_size)
+                    if self.hash_index is not None:
+                        self.hash_index.update(data, offset)
+                elif self.hash_index is not None:
+                    runs = self.hash_index.changed_runs(data, offset)
+                    unchanged += length - sum(end - start for start, end in runs)
+                elif self.compare_chunk_size is not None:
+                    current = self._device.read(offset, length)
+                    # Past the end of the device, there is nothing to compare against
+                    if len(current) == length:
+                        runs = changed_runs(data, current, offset, self.compare_chunk_size)
+                        unchanged += length - sum(end - start for start, end in runs)
+                if runs is None:
+                    extents.append((offset, data))
+                    written += length
+                else:
+                    view = memoryview(data)
+                    for start, end in runs:
+                        extents.append((offset + start, view[start:end]))
+                        written += end - start
+            self._device.write_extents(extents)
+        except Exception as e:
+            # We can't tell which extent of the batch failed, so report the whole range
+            start = min(item[0] for item in items)
+            end = max(item[0] + item[1] for item in items)
+            self._fail(e, start, end - start, True, f'WRITE of {len(items)} extent(s)')
+        else:
+            with self._stats_lock:
+                self.stats.written += written
+                self.stats.unchanged += unchanged
+                self.stats.skipped += sum(item[1] for item in items) - written - unchanged
+        finally:
+            for offset, length, exists, data, buffer in items:
+                self._release(length, buffer)
+
+    def _discard(self, offset: int, length: int, exists: bool):
+        try:
+            self._device.zero_range(offset, length, self.discard_block_size)
+            if self.hash_index is not None:
+                self.hash_index.zeroed(offset, length)
+            with self._stats_lock:
+                self.stats.written += length
+                self.stats.discarded += length
+        except Exception as e:
+            self._fail(e, offset, length, exists, 'DISCARD')
+        finally:
+            self._release(0)
+
+    def _writer_loop(self):
+        while True:
+            batch = [self._write_queue.get()]
+            # Pick up whatever else is already waiting, so adjacent extents can be written together
+            while len(batch) < _WRITE_BATCH and batch[-1] is not _STOP:
+                try:
+                    batch.append(self._write_queue.get_nowait())
+                except queue.Empty:
+                    break
+            items = []
+            for item in batch:
+                if item is _STOP:
+                    continue
+                offset, length, exists, data, buffer = item
+                if self.failures:
+                    self._release(0 if data is None else length, buffer)
+                elif data is None:
+                    self._discard(offset, length, exists)
+                else:
+                    items.append(item)
+            if items:
+                self._write_batch(items)
+            if batch[-1] is _STOP:
+                return
@@ -80,6 +80,9 @@ class WebController:
             'name': item.name,
             'status_type': item.status_type.label,
             'status_message': item.status_text,
+            'expected_bytes': item.expected_bytes,
+            'transferred_bytes': item.transferred_bytes,
+            'eta_seconds': item.eta_seconds,
             'children': [self.format_status_simple(child) for child in item.children.values()]
         }
 
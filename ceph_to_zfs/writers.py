@@ -0,0 +1,473 @@
+import abc
+import ctypes
+import ctypes.util
+import errno
+import mmap
+import os
+import threading
+from typing import Optional
+
+from ceph_to_zfs import blockdev
+from ceph_to_zfs.buffers import BufferPool, buffer_address
+
+try:
+    _IOV_MAX = os.sysconf('SC_IOV_MAX')
+except (AttributeError, ValueError, OSError):
+    _IOV_MAX = 1024
+if _IOV_MAX <= 0:
+    _IOV_MAX = 1024
+
+_libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+_libc.syscall.restype = ctypes.c_long
+
+# From linux/io_uring.h. The syscall numbers are the same on every architecture.
+_SYS_IO_URING_SETUP = 425
+_SYS_IO_URING_ENTER = 426
+_IORING_OFF_SQ_RING = 0
+_IORING_OFF_CQ_RING = 0x8000000
+_IORING_OFF_SQES = 0x10000000
+_IORING_OP_WRITEV = 2
+_IORING_ENTER_GETEVENTS = 1
+
+
+class _SqringOffsets(ctypes.Structure):
+    _fields_ = [('head', ctypes.c_uint32), ('tail', ctypes.c_uint32), ('ring_mask', ctypes.c_uint32),
+                ('ring_entries', ctypes.c_uint32), ('flags', ctypes.c_uint32), ('dropped', ctypes.c_uint32),
+                ('array', ctypes.c_uint32), ('resv1', ctypes.c_uint32), ('resv2', ctypes.c_uint64)]
+
+
+class _CqringOffsets(ctypes.Structure):
+    _fields_ = [('head', ctypes.c_uint32), ('tail', ctypes.c_uint32), ('ring_mask', ctypes.c_uint32),
+                ('ring_entries', ctypes.c_uint32), ('overflow', ctypes.c_uint32), ('cqes', ctypes.c_uint32),
+                ('flags', ctypes.c_uint32), ('resv1', ctypes.c_uint32), ('resv2', ctypes.c_uint64)]
+
+
+class _IoUringParams(ctypes.Structure):
+    _fields_ = [('sq_entries', ctypes.c_uint32), ('cq_entries', ctypes.c_uint32), ('flags', ctypes.c_uint32),
+                ('sq_thread_cpu', ctypes.c_uint32), ('sq_thread_idle', ctypes.c_uint32),
+                ('features', ctypes.c_uint32), ('wq_fd', ctypes.c_uint32), ('resv', ctypes.c_uint32 * 3),
+                ('sq_off', _SqringOffsets), ('cq_off', _CqringOffsets)]
+
+
+class _Sqe(ctypes.Structure):
+    _fields_ = [('opcode', ctypes.c_uint8), ('flags', ctypes.c_uint8), ('ioprio', ctypes.c_uint16),
+                ('fd', ctypes.c_int32), ('off', ctypes.c_uint64), ('addr', ctypes.c_uint64),
+                ('len', ctypes.c_uint32), ('rw_flags', ctypes.c_uint32), ('user_data', ctypes.c_uint64),
+                ('pad', ctypes.c_uint64 * 3)]
+
+
+class _Cqe(ctypes.Structure):
+    _fields_ = [('user_data', ctypes.c_uint64), ('res', ctypes.c_int32), ('flags', ctypes.c_uint32)]
+
+
+class _Iovec(ctypes.Structure):
+    _fields_ = [('iov_base', ctypes.c_void_p), ('iov_len', ctypes.c_size_t)]
+
+
+def _check_syscall(ret: int) -> int:
+    if ret < 0:
+        err = ctypes.get_errno()
+        raise OSError(err, os.strerror(err))
+    return ret
+
+
+def _slice_buffers(buffers: list[memoryview], start: int, end: int) -> list[memoryview]:
+    """
+    Views of the bytes from start to end of a list of buffers, as if they were concatenated.
+    """
+    views = []
+    position = 0
+    for buffer in buffers:
+        buffer_end = position + buffer.nbytes
+        if buffer_end > start and position < end:
+            views.append(buffer[max(start - position, 0):min(end, buffer_end) - position])
+        position = buffer_end
+        if position >= end:
+            break
+    return views
+
+
+def coalesce(extents: list[tuple[int, object]]) -> list[tuple[int, list[memoryview]]]:
+    """
+    Group (offset, data) pairs into runs which are contiguous on the device.
+
+    Returns (offset, buffers) pairs, in offset order, where the buffers of each run follow each other on the device
+    and can be written with a single vectored write. Empty buffers are dropped.
+    """
+    runs: list[tuple[int, list[memoryview]]] = []
+    run_end = None
+    for offset, data in sorted(extents, key=lambda extent: extent[0]):
+        view = memoryview(data).cast('B')
+        if not view.nbytes:
+            continue
+        if offset == run_end:
+            runs[-1][1].append(view)
+        else:
+            runs.append((offset, [view]))
+        run_end = offset + view.nbytes
+    return runs
+
+
+class DeviceWriter(metaclass=abc.ABCMeta):
+    """
+    Writes extents to the destination zvol (or a regular file).
+
+    Implementations must be safe to call from several threads at once, i.e. they must not keep a shared file
+    position.
+    """
+
+    @abc.abstractmethod
+    def write_extents(self, extents: list[tuple[int, object]]):
+        """
+        Write a batch of (offset, data) pairs. The extents must not overlap.
+        """
+        raise NotImplemented
+
+    @abc.abstractmethod
+    def zero_range(self, offset: int, length: int, block_size: int):
+        """
+        Make a range read back as zeroes, see blockdev.zero_range.
+        """
+        raise NotImplemented
+
+    @abc.abstractmethod
+    def read(self, offset: int, length: int) -> bytearray:
+        """
+        Read back what is currently on the device. May return less than length bytes at the end of the device.
+        """
+        raise NotImplemented
+
+    @abc.abstractmethod
+    def close(self):
+        raise NotImplemented
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type_, value, traceback):
+        self.close()
+        return False
+
+
+class PwriteWriter(DeviceWriter):
+    """
+    Writes with os.pwrite()/os.pwritev() on a raw file descriptor. Extents which are adjacent on the device are
+    written together with one pwritev() call.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.fd = os.open(path, os.O_RDWR)
+
+    def write_extents(self, extents: list[tuple[int, object]]):
+        for offset, buffers in coalesce(extents):
+            self._pwritev_all(self.fd, offset, buffers)
+
+    def zero_range(self, offset: int, length: int, block_size: int):
+        blockdev.zero_range(self.fd, offset, length, block_size)
+
+    def read(self, offset: int, length: int) -> bytearray:
+        buffer = bytearray(length)
+        view = memoryview(buffer)
+        count = 0
+        while count < length:
+            read = os.preadv(self.fd, [view[count:]], offset + count)
+            if read == 0:
+                return buffer[:count]
+            count += read
+        return buffer
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+    @staticmethod
+    def _pwritev_all(fd: int, offset: int, buffers: list[memoryview]):
+        if len(buffers) == 1 or not hasattr(os, 'pwritev'):
+            for buffer in buffers:
+                PwriteWriter._pwrite_all(fd, offset, buffer)
+                offset += buffer.nbytes
+            return
+        first = 0
+        while first < len(buffers):
+            count = os.pwritev(fd, buffers[first:first + _IOV_MAX], offset)
+            offset += count
+            # Skip the buffers which were written completely, and trim a partially written one
+            while first < len(buffers) and count >= buffers[first].nbytes:
+                count -= buffers[first].nbytes
+                first += 1
+            if count:
+                buffers[first] = buffers[first][count:]
+
+    @staticmethod
+    def _pwrite_all(fd: int, offset: int, view: memoryview):
+        while view:
+            count = os.pwrite(fd, view, offset)
+            offset += count
+            view = view[count:]
+
+
+class DirectWriter(PwriteWriter):
+    """
+    Writes with O_DIRECT, so that zvol data does not fill up the page cache.
+
+    The page-aligned part of each run of extents is written with O_DIRECT, copying buffers which are not aligned in
+    memory into a staging buffer first. Unaligned heads and tails go through a buffered fd, followed by
+    posix_fadvise(DONTNEED). If the device can't be opened with O_DIRECT, everything goes through the buffered fd.
+    """
+
+    def __init__(self, path: str, staging_size: int = 4 * 1024 * 1024):
+        super().__init__(path)
+        self.alignment = mmap.PAGESIZE
+        try:
+            self.direct_fd = os.open(path, os.O_RDWR | os.O_DIRECT)
+        except OSError as e:
+            if e.errno != errno.EINVAL:
+                raise
+            self.direct_fd = None
+        self._staging = BufferPool(staging_size, max_free=8)
+
+    def write_extents(self, extents: list[tuple[int, object]]):
+        for offset, buffers in coalesce(extents):
+            end = offset + sum(buffer.nbytes for buffer in buffers)
+            direct_start = -(-offset // self.alignment) * self.alignment
+            direct_end = end // self.alignment * self.alignment
+            if self.direct_fd is None or direct_end <= direct_start:
+                direct_start = direct_end = end
+            if offset < direct_start:
+                self._write_buffered(offset, _slice_buffers(buffers, 0, direct_start - offset))
+            if direct_start < direct_end:
+                self._write_direct(direct_start, _slice_buffers(buffers, direct_start - offset, direct_end - offset))
+            if direct_end < end:
+                self._write_buffered(direct_end, _slice_buffers(buffers, direct_end - offset, end - offset))
+
+    def zero_range(self, offset: int, length: int, block_size: int):
+        super().zero_range(offset, length, block_size)
+        os.posix_fadvise(self.fd, offset, length, os.POSIX_FADV_DONTNEED)
+
+    def read(self, offset: int, length: int) -> bytearray:
+        buffer = super().read(offset, length)
+        os.posix_fadvise(self.fd, offset, length, os.POSIX_FADV_DONTNEED)
+        return buffer
+
+    def close(self):
+        if self.direct_fd is not None:
+            os.close(self.direct_fd)
+            self.direct_fd = None
+        super().close()
+
+    def _write_buffered(self, offset: int, views: list[memoryview]):
+        self._pwritev_all(self.fd, offset, views)
+        os.posix_fadvise(self.fd, offset, sum(view.nbytes for view in views), os.POSIX_FADV_DONTNEED)
+
+    def _write_direct(self, offset: int, views: list[memoryview]):
+        if all(self._is_aligned(view) for view in views):
+            self._pwritev_all(self.direct_fd, offset, views)
+            return
+        staging = self._staging.acquire()
+        try:
+            filled = 0
+            for view in views:
+                position = 0
+                while position < view.nbytes:
+                    count = min(view.nbytes - position, len(staging) - filled)
+                    staging[filled:filled + count] = view[position:position + count]
+                    filled += count
+                    position += count
+                    if filled == len(staging):
+                        self._pwrite_all(self.direct_fd, offset, memoryview(staging))
+                        offset += filled
+                        filled = 0
+            if filled:
+                # The direct range is a multiple of the alignment, so this is too
+                self._pwrite_all(self.direct_fd, offset, memoryview(staging)[:filled])
+        finally:
+            self._staging.release(staging)
+
+    def _is_aligned(self, view: memoryview) -> bool:
+        if view.nbytes % self.alignment:
+            return False
+        address, c_view = buffer_address(view)
+        try:
+            return address % self.alignment == 0
+        finally:
+            del c_view
+
+
+class _IoUring:
+    """
+    A minimal io_uring, set up with the raw syscalls, which submits a batch of writev operations and waits for all
+    of them. Not thread-safe.
+    """
+
+    def __init__(self, entries: int):
+        params = _IoUringParams()
+        self.fd = _check_syscall(_libc.syscall(ctypes.c_long(_SYS_IO_URING_SETUP), ctypes.c_uint(entries),
+                                               ctypes.byref(params)))
+        try:
+            self.entries = params.sq_entries
+            sq_off, cq_off = params.sq_off, params.cq_off
+            self._sq_map = mmap.mmap(self.fd, sq_off.array + params.sq_entries * 4, offset=_IORING_OFF_SQ_RING)
+            self._cq_map = mmap.mmap(self.fd, cq_off.cqes + params.cq_entries * ctypes.sizeof(_Cqe),
+                                     offset=_IORING_OFF_CQ_RING)
+            self._sqe_map = mmap.mmap(self.fd, params.sq_entries * ctypes.sizeof(_Sqe), offset=_IORING_OFF_SQES)
+        except Exception:
+            os.close(self.fd)
+            raise
+        self._sq_tail = ctypes.c_uint32.from_buffer(self._sq_map, sq_off.tail)
+        self._sq_mask = ctypes.c_uint32.from_buffer(self._sq_map, sq_off.ring_mask).value
+        self._sq_array = (ctypes.c_uint32 * params.sq_entries).from_buffer(self._sq_map, sq_off.array)
+        self._sqes = (_Sqe * params.sq_entries).from_buffer(self._sqe_map)
+        self._cq_head = ctypes.c_uint32.from_buffer(self._cq_map, cq_off.head)
+        self._cq_tail = ctypes.c_uint32.from_buffer(self._cq_map, cq_off.tail)
+        self._cq_mask = ctypes.c_uint32.from_buffer(self._cq_map, cq_off.ring_mask).value
+        self._cqes = (_Cqe * params.cq_entries).from_buffer(self._cq_map, cq_off.cqes)
+
+    def writev(self, ops: list[tuple[int, int, ctypes.Array]]) -> list[int]:
+        """
+        Submit up to `entries` (fd, offset, iovecs) writes with as few syscalls as possible, and wait for all of
+        them. Returns the result of each write, which is the number of bytes written or a negative errno.
+        """
+        tail = self._sq_tail.value
+        for i, (fd, offset, iovecs) in enumerate(ops):
+            index = (tail + i) & self._sq_mask
+            sqe = self._sqes[index]
+            ctypes.memset(ctypes.addressof(sqe), 0, ctypes.sizeof(_Sqe))
+            sqe.opcode = _IORING_OP_WRITEV
+            sqe.fd = fd
+            sqe.off = offset
+            sqe.addr = ctypes.addressof(iovecs)
+            sqe.len = len(iovecs)
+            sqe.user_data = i
+            self._sq_array[index] = index
+        # The syscall is a full barrier, so the kernel sees the entries before the new tail
+        self._sq_tail.value = (tail + len(ops)) & 0xffffffff
+        results: list[Optional[int]] = [None] * len(ops)
+        to_submit = len(ops)
+        remaining = len(ops)
+        while remaining:
+            ret = _libc.syscall(ctypes.c_long(_SYS_IO_URING_ENTER), ctypes.c_uint(self.fd),
+                                ctypes.c_uint(to_submit), ctypes.c_uint(remaining),
+                                ctypes.c_uint(_IORING_ENTER_GETEVENTS), ctypes.c_void_p(None), ctypes.c_size_t(0))
+            if ret < 0:
+                err = ctypes.get_errno()
+                if err not in (errno.EINTR, errno.EAGAIN, errno.EBUSY):
+                    # Wait for the writes which were submitted, so that their buffers can be reused
+                    self._drain(remaining - to_submit, results)
+                    raise OSError(err, os.strerror(err))
+            else:
+                to_submit -= ret
+            remaining -= self._reap(results)
+        return results
+
+    def _reap(self, results: list[Optional[int]]) -> int:
+        head = self._cq_head.value
+        cq_tail = self._cq_tail.value
+        count = 0
+        while head != cq_tail:
+            cqe = self._cqes[head & self._cq_mask]
+            results[cqe.user_data] = cqe.res
+            count += 1
+            head = (head + 1) & 0xffffffff
+        self._cq_head.value = head
+        return count
+
+    def _drain(self, in_flight: int, results: list[Optional[int]]):
+        """
+        Wait for in_flight submitted writes to complete, as far as the kernel lets us.
+        """
+        in_flight -= self._reap(results)
+        while in_flight > 0:
+            ret = _libc.syscall(ctypes.c_long(_SYS_IO_URING_ENTER), ctypes.c_uint(self.fd), ctypes.c_uint(0),
+                                ctypes.c_uint(in_flight), ctypes.c_uint(_IORING_ENTER_GETEVENTS),
+                                ctypes.c_void_p(None), ctypes.c_size_t(0))
+            if ret < 0 and ctypes.get_errno() != errno.EINTR:
+                return
+            in_flight -= self._reap(results)
+
+    def close(self):
+        # The ctypes views have to go before the maps can be closed
+        del self._sq_tail, self._sq_array, self._sqes, self._cq_head, self._cq_tail, self._cqes
+        for ring_map in (self._sq_map, self._cq_map, self._sqe_map):
+            ring_map.close()
+        os.close(self.fd)
+
+
+class UringWriter(PwriteWriter):
+    """
+    Writes with io_uring, submitting and waiting for a whole batch of extents with one syscall. Each batch is
+    waited for before the next one is submitted. If io_uring is not available, or the ring fails, this behaves
+    like PwriteWriter.
+    """
+
+    def __init__(self, path: str, entries: int = 256):
+        super().__init__(path)
+        self._lock = threading.Lock()
+        try:
+            self._ring = _IoUring(entries)
+        except OSError:
+            self._ring = None
+
+    @property
+    def using_io_uring(self) -> bool:
+        return self._ring is not None
+
+    def write_extents(self, extents: list[tuple[int, object]]):
+        if self._ring is None:
+            super().write_extents(extents)
+            return
+        ops: list[tuple[int, list[memoryview]]] = []
+        for offset, buffers in coalesce(extents):
+            for first in range(0, len(buffers), _IOV_MAX):
+                chunk = buffers[first:first + _IOV_MAX]
+                ops.append((offset, chunk))
+                offset += sum(buffer.nbytes for buffer in chunk)
+        with self._lock:
+            first = 0
+            while first < len(ops):
+                if self._ring is None:
+                    # io_uring failed, in this batch or in another thread
+                    for offset, buffers in ops[first:]:
+                        self._pwritev_all(self.fd, offset, buffers)
+                    return
+                count = self._ring.entries
+                self._write_ops(ops[first:first + count])
+                first += count
+
+    def _write_ops(self, ops: list[tuple[int, list[memoryview]]]):
+        c_buffers = []
+        ring_ops = []
+        try:
+            for offset, buffers in ops:
+                iovecs = (_Iovec * len(buffers))()
+                for iovec, buffer in zip(iovecs, buffers):
+                    address, c_buffer = buffer_address(buffer)
+                    c_buffers.append(c_buffer)
+                    iovec.iov_base = address
+                    iovec.iov_len = buffer.nbytes
+                ring_ops.append((self.fd, offset, iovecs))
+            try:
+                results = self._ring.writev(ring_ops)
+            except OSError:
+                # The ring may still hold entries for this batch, so it can't be used again. Writing the whole
+                # batch again is harmless.
+                self._ring.close()
+                self._ring = None
+                for offset, buffers in ops:
+                    self._pwritev_all(self.fd, offset, list(buffers))
+                return
+        finally:
+            del c_buffers
+        for (offset, buffers), result in zip(ops, results):
+            if result < 0:
+                raise OSError(-result, os.strerror(-result))
+            length = sum(buffer.nbytes for buffer in buffers)
+            if result < length:
+                self._pwritev_all(self.fd, offset + result, _slice_buffers(buffers, result, length))
+
+    def close(self):
+        if self._ring is not None:
+            self._ring.close()
+            self._ring = None
+        super().close()
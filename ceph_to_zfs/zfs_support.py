@@ -1,12 +1,18 @@
-import os
-import time
+import threading
 from datetime import datetime
 from typing import Optional
 
 import libzfs
 
+from ceph_to_zfs import blockdev
 from ceph_to_zfs.statuslogger import Loggable, JobLogger
 
+# ZFS user property recording how many bytes the last backup of a zvol read from RBD
+LAST_READ_BYTES_PROPERTY = 'ceph-to-zfs:last-read-bytes'
+# ZFS user property recording the snapshot the last backup of a zvol created, as "<name>@<RBD snapshot id>"
+LAST_SNAPSHOT_PROPERTY = 'ceph-to-zfs:last-snapshot'
+
+
 def zfs_snapshot_name(snap: libzfs.ZFSSnapshot) -> str:
     return snap.name.split('@')[-1]
 
@@ -17,15 +23,47 @@ def zfs_snapshot_created_time(snap: libzfs.ZFSSnapshot) -> datetime:
 
 
 class ZfsContext(Loggable):
-    def __init__(self, status_logger: JobLogger, base_dataset: libzfs.ZFSDataset):
+    """
+    The parent dataset which a pool's zvols are created under.
+
+    The children are listed once and kept in a name -> dataset index, since listing them is slow with many zvols.
+    Call invalidate() if they are changed by anything other than this class.
+    """
+
+    def __init__(self, status_logger: JobLogger, base_dataset: libzfs.ZFSDataset, zfs: Optional[libzfs.ZFS] = None):
         super().__init__(status_logger)
         self._base = base_dataset
+        # Used to look up newly created zvols without listing all children again
+        self._zfs = zfs
+        self._children: Optional[dict[str, libzfs.ZFSDataset]] = None
+        self._lock = threading.Lock()
+
+    def _child_index(self) -> dict[str, libzfs.ZFSDataset]:
+        with self._lock:
+            if self._children is None:
+                self._children = {child.name.split('/')[-1]: child for child in self._base.children}
+            return self._children
+
+    def invalidate(self):
+        with self._lock:
+            self._children = None
+
+    def lookup_snapshot(self, path: str) -> Optional[libzfs.ZFSSnapshot]:
+        """
+        Look up a single snapshot by its full path without listing its dataset's snapshots. Returns None if it does
+        not exist.
+
+        Raises LookupError if there is no libzfs handle to do that with.
+        """
+        if self._zfs is None:
+            raise LookupError('No libzfs handle for direct snapshot lookups')
+        try:
+            return self._zfs.get_snapshot(path)
+        except libzfs.ZFSException:
+            return None
 
     def get_child(self, name: str) -> Optional[libzfs.ZFSDataset]:
-        for child in self._base.children:
-            if child.name.split('/')[-1] == name:
-                return child
-        return None
+        return self._child_index().get(name)
 
     def create_child_vol(self, name: str, size: int) -> libzfs.ZFSDataset:
         pool: libzfs.ZFSPool = self._base.pool
@@ -39,6 +77,13 @@ class ZfsContext(Loggable):
             },
             fstype=libzfs.DatasetType.VOLUME,
             sparse_vol=True)
+        if self._zfs is None:
+            self.invalidate()
+        else:
+            child = self._zfs.get_dataset(self._base.name + '/' + name)
+            with self._lock:
+                if self._children is not None:
+                    self._children[name] = child
         return self.get_child(name)
 
     @property
@@ -52,28 +97,78 @@ class ZfsDatasetContext(Loggable):
         super().__init__(status_logger)
         self._base = base
         self.name = name
+        # Set by prepare() if it had to create the zvol
+        self.created = False
+        # Snapshots sorted by creation time, and by name. Filled in on first use, cleared by invalidate_snapshots().
+        self._snapshots: Optional[list[libzfs.ZFSSnapshot]] = None
+        self._snapshots_by_name: dict[str, libzfs.ZFSSnapshot] = {}
 
     @property
     def volume(self) -> Optional[libzfs.ZFSDataset]:
         return self._base.get_child(self.name)
 
+    def _snapshot_index(self) -> list[libzfs.ZFSSnapshot]:
+        if self._snapshots is None:
+            existing = self.volume
+            snaps: list[libzfs.ZFSSnapshot] = list(existing.snapshots) if existing is not None else []
+            snaps.sort(key=zfs_snapshot_created_time)
+            self._snapshots_by_name = {zfs_snapshot_name(snap): snap for snap in snaps}
+            self._snapshots = snaps
+        return self._snapshots
+
+    def invalidate_snapshots(self):
+        self._snapshots = None
+        self._snapshots_by_name = {}
+
     @property
     def all_snapshots(self) -> list[libzfs.ZFSSnapshot]:
-        existing = self.volume
-        if existing is not None:
-            snaps: list[libzfs.ZFSSnapshot] = list(existing.snapshots)
-            snaps.sort(key=zfs_snapshot_created_time)
-            return snaps
-        else:
-            return []
+        return list(self._snapshot_index())
 
     def get_snapshot_by_name(self, name: str) -> libzfs.ZFSSnapshot:
-        for snapshot in self.all_snapshots:
-            if zfs_snapshot_name(snapshot) == name:
-                return snapshot
-        raise KeyError(f'Dataset {self.zfs_path} does not have a snapshot with name "{name}"')
-
-    def prepare(self, snapshot: Optional[str | libzfs.ZFSSnapshot], required_size: int):
+        snapshot = None
+        if self._snapshots is None:
+            # Avoid listing every snapshot just to find one
+            try:
+                snapshot = self._base.lookup_snapshot(self.zfs_path + '@' + name)
+            except LookupError:
+                self._snapshot_index()
+        if self._snapshots is not None:
+            snapshot = self._snapshots_by_name.get(name)
+        if snapshot is None:
+            raise KeyError(f'Dataset {self.zfs_path} does not have a snapshot with name "{name}"')
+        return snapshot
+
+    def has_snapshot(self, name: str) -> bool:
+        try:
+            self.get_snapshot_by_name(name)
+            return True
+        except KeyError:
+            return False
+
+    def snapshot_guid(self, name: str) -> int:
+        return self.get_snapshot_by_name(name).properties['guid'].parsed
+
+    def unchanged_since(self, ds: libzfs.ZFSDataset, snapshot: libzfs.ZFSSnapshot) -> bool:
+        """
+        Whether the zvol still holds exactly what is in a snapshot, i.e. rolling back to it would do nothing.
+        Uses 'written@<snapshot>' if libzfs exposes it, else 'written' if the snapshot is the newest one.
+        """
+        name = zfs_snapshot_name(snapshot)
+        try:
+            written_since = ds.properties.get(f'written@{name}')
+        except (KeyError, libzfs.ZFSException):
+            written_since = None
+        if written_since is not None and isinstance(written_since.parsed, int):
+            return written_since.parsed == 0
+        if ds.properties['written'].parsed != 0:
+            return False
+        recorded = self.get_user_property(LAST_SNAPSHOT_PROPERTY)
+        if recorded and recorded.rpartition('@')[0] == name:
+            return True
+        snaps = self._snapshot_index()
+        return bool(snaps) and snaps[-1].properties['guid'].parsed == snapshot.properties['guid'].parsed
+
+    def prepare(self, snapshot: Optional[str | libzfs.ZFSSnapshot], required_size: int, device_timeout: float = 60.0):
         self.set_status('Preparing Target Zvol')
         ds = self.volume
 
@@ -81,20 +176,28 @@ class ZfsDatasetContext(Loggable):
             self.set_status('Creating Target Zvol')
             self.log(f'Dataset {self.zfs_path} does not exist - creating')
             ds = self._base.create_child_vol(self.name, required_size)
-            self.log(f'Created {self.zfs_path}, waiting for {self.device_node} to exist...')
-            while not os.path.exists(self.device_node):
-                time.sleep(0.5)
+            self.created = True
+            self.invalidate_snapshots()
+            self.log(f'Created {self.zfs_path}')
 
         elif ds.type != libzfs.DatasetType.VOLUME:
             raise RuntimeError(f'Dataset for {self.zfs_path} exists but is not a volume!')
 
+        # udev creates the device node, and fixes its permissions, some time after the zvol is created
+        if not blockdev.device_ready(self.device_node):
+            self.log(f'Waiting up to {device_timeout}s for {self.device_node} to be ready...')
+            blockdev.wait_for_device(self.device_node, device_timeout)
+
         if snapshot is not None:
             self.set_status('Rolling Zvol back to snapshot')
             if isinstance(snapshot, str):
                 snapshot = self.get_snapshot_by_name(snapshot)
-            self.log(f'Rolling back to {snapshot.name}')
-            snapshot.rollback()
-            pass
+            if self.unchanged_since(ds, snapshot):
+                self.log(f'Nothing written since {snapshot.name}, not rolling back')
+            else:
+                self.log(f'Rolling back to {snapshot.name}')
+                snapshot.rollback()
+                self.invalidate_snapshots()
 
         existing_size = ds.properties['volsize'].parsed
         if existing_size < required_size:
@@ -108,10 +211,26 @@ class ZfsDatasetContext(Loggable):
     def zfs_path(self) -> str:
         return self._base.zfs_path + '/' + self.name
 
+    @property
+    def volblocksize(self) -> int:
+        return self.volume.properties['volblocksize'].parsed
+
     @property
     def device_node(self) -> str:
         return f'/dev/zvol/{self.volume.name}'
 
+    def get_user_property(self, name: str) -> Optional[str]:
+        volume = self.volume
+        if volume is None:
+            return None
+        prop = volume.properties.get(name)
+        return None if prop is None else prop.value
+
+    def set_user_property(self, name: str, value: str):
+        self.volume.properties[name] = libzfs.ZFSUserProperty(value)
+
     def create_snapshot(self, new_snap_name: str):
-        return self.volume.snapshot(self.zfs_path + '@' + new_snap_name)
+        result = self.volume.snapshot(self.zfs_path + '@' + new_snap_name)
+        self.invalidate_snapshots()
+        return result
 
@@ -12,6 +12,7 @@ from ctypes import CDLL, c_char_p, c_size_t, c_void_p, c_char, c_int, c_long, \
 from ctypes.util import find_library
 import ctypes
 import errno
+import queue
 import threading
 import time
 import sys
@@ -185,53 +186,99 @@ class Version(object):
         return "%d.%d.%d" % (self.major, self.minor, self.extra)
 
 
-class RadosThread(threading.Thread):
-    def __init__(self, target, args=None):
-        self.args = args
+class RadosCall(object):
+    """A librados call waiting to run on a dispatcher thread"""
+    def __init__(self, target, args):
         self.target = target
-        threading.Thread.__init__(self)
+        self.args = args
+        self.done = threading.Event()
+        self.retval = None
+        self.exc = None
 
     def run(self):
-        self.retval = self.target(*self.args)
+        try:
+            self.retval = self.target(*self.args)
+        except BaseException as e:
+            self.exc = e
+        finally:
+            self.done.set()
 
-# time in seconds between each call to t.join() for child thread
-POLL_TIME_INCR = 0.5
 
+class RadosDispatcher(object):
+    """
+    A pool of persistent daemon threads for running blocking librados
+    calls, so that a call does not need a new thread each time.
 
-def run_in_thread(target, args, timeout=0):
-    interrupt = False
+    A new thread is only started when every existing one is busy (for
+    example, stuck in a call which timed out), and threads exit after
+    being idle for IDLE_TIMEOUT seconds.
+    """
+    IDLE_TIMEOUT = 60
+
+    def __init__(self):
+        self.queue = queue.Queue()
+        self.lock = threading.Lock()
+        self.idle = 0
+
+    def submit(self, call):
+        with self.lock:
+            if self.idle:
+                # reserve an idle worker for this call
+                self.idle -= 1
+            else:
+                t = threading.Thread(target=self.worker, name='rados-dispatch')
+                t.daemon = True
+                t.start()
+            self.queue.put(call)
+
+    def worker(self):
+        while True:
+            try:
+                call = self.queue.get(timeout=self.IDLE_TIMEOUT)
+            except queue.Empty:
+                with self.lock:
+                    if self.idle and self.queue.empty():
+                        self.idle -= 1
+                        return
+                continue
+            call.run()
+            with self.lock:
+                self.idle += 1
 
-    countdown = timeout
-    t = RadosThread(target, args)
 
-    # allow the main thread to exit (presumably, avoid a join() on this
-    # subthread) before this thread terminates.  This allows SIGINT
-    # exit of a blocked call.  See below.
-    t.daemon = True
+_dispatcher = RadosDispatcher()
 
-    t.start()
+
+def run_in_thread(target, args, timeout=0):
+    """
+    Run a blocking librados call so that it can be interrupted with
+    SIGINT, or abandoned after timeout seconds. Returns -EINTR in both
+    cases.
+
+    Python only delivers signals to the main thread, so a call from any
+    other thread without a timeout runs directly (ctypes releases the
+    GIL while it blocks). Otherwise the call runs on a dispatcher
+    thread while this thread waits on an event, which wakes as soon as
+    the call finishes rather than polling.
+    """
+    if not timeout and threading.current_thread() is not threading.main_thread():
+        return target(*args)
+
+    call = RadosCall(target, args)
+    _dispatcher.submit(call)
     try:
-        # poll for thread exit
-        while t.is_alive():
-            t.join(POLL_TIME_INCR)
-            if timeout and t.is_alive():
-                countdown = countdown - POLL_TIME_INCR
-                if countdown <= 0:
-                    raise KeyboardInterrupt
-
-        t.join()        # in case t exits before reaching the join() above
+        # A blocked wait in the main thread is still interrupted by
+        # SIGINT, which raises KeyboardInterrupt here
+        if not call.done.wait(timeout or None):
+            return -errno.EINTR
     except KeyboardInterrupt:
-        # ..but allow SIGINT to terminate the waiting.  Note: this
-        # relies on the Linux kernel behavior of delivering the signal
-        # to the main thread in preference to any subthread (all that's
-        # strictly guaranteed is that *some* thread that has the signal
-        # unblocked will receive it).  But there doesn't seem to be
-        # any interface to create t with SIGINT blocked.
-        interrupt = True
-
-    if interrupt:
-        t.retval = -errno.EINTR
-    return t.retval
+        # the call keeps running on its (daemon) thread, which does
+        # not prevent the process from exiting
+        return -errno.EINTR
+
+    if call.exc is not None:
+        raise call.exc
+    return call.retval
 
 
 # helper to specify an optional argument, where in addition to `cls`, `None`
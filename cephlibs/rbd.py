@@ -21,6 +21,7 @@ from ctypes.util import find_library
 import ctypes
 import errno
 import sys
+import threading
 
 from cephlibs.rados import cstr, decode_cstr
 
@@ -66,6 +67,7 @@ RBD_FEATURES_SINGLE_CLIENT = (RBD_FEATURE_EXCLUSIVE_LOCK |
                               RBD_FEATURE_FAST_DIFF)
 
 RBD_FLAG_OBJECT_MAP_INVALID = 1
+RBD_FLAG_FAST_DIFF_INVALID = 2
 
 
 # Are we running Python 2.x
@@ -190,10 +192,48 @@ class rbd_snap_info_t(Structure):
                 ("name", c_char_p)]
 
 
-def load_librbd():
-    """
-    Load the librbd shared library.
-    """
+RBD_CALLBACK = CFUNCTYPE(None, c_void_p, c_void_p)
+RBD_DIFF_CB = CFUNCTYPE(c_int, c_uint64, c_size_t, c_int, c_void_p)
+
+# Prototypes for the functions on the I/O path. Without these, ctypes
+# assumes every return value is an int, which truncates the ssize_t
+# results of reads and writes, and converts every argument by guesswork
+# on every call.
+_READ_ARGS = [c_void_p, c_uint64, c_size_t, c_void_p]
+_AIO_ARGS = [c_void_p, c_uint64, c_size_t, c_void_p, c_void_p]
+_PROTOTYPES = {
+    'rbd_read': (ctypes.c_ssize_t, _READ_ARGS),
+    'rbd_read2': (ctypes.c_ssize_t, _READ_ARGS + [c_int]),
+    'rbd_write': (ctypes.c_ssize_t, _READ_ARGS),
+    'rbd_write2': (ctypes.c_ssize_t, _READ_ARGS + [c_int]),
+    'rbd_aio_read': (c_int, _AIO_ARGS),
+    'rbd_aio_read2': (c_int, _AIO_ARGS + [c_int]),
+    'rbd_aio_write': (c_int, _AIO_ARGS),
+    'rbd_aio_write2': (c_int, _AIO_ARGS + [c_int]),
+    'rbd_aio_flush': (c_int, [c_void_p, c_void_p]),
+    'rbd_aio_create_completion': (c_int, [c_void_p, RBD_CALLBACK, c_void_p]),
+    'rbd_aio_is_complete': (c_int, [c_void_p]),
+    'rbd_aio_wait_for_complete': (c_int, [c_void_p]),
+    'rbd_aio_get_return_value': (ctypes.c_ssize_t, [c_void_p]),
+    'rbd_aio_release': (None, [c_void_p]),
+    'rbd_diff_iterate2': (c_int, [c_void_p, c_char_p, c_uint64, c_uint64,
+                                  c_uint8, c_uint8, RBD_DIFF_CB, c_void_p]),
+}
+
+_librbd = None
+_librbd_lock = threading.Lock()
+
+
+def _configure_prototypes(librbd):
+    for name, (restype, argtypes) in _PROTOTYPES.items():
+        # Older versions of librbd don't have all of these
+        if hasattr(librbd, name):
+            func = getattr(librbd, name)
+            func.restype = restype
+            func.argtypes = argtypes
+
+
+def _open_librbd():
     librbd_path = find_library('rbd')
     if librbd_path:
         return CDLL(librbd_path)
@@ -206,6 +246,23 @@ def load_librbd():
         raise EnvironmentError("Unable to load librbd: %s" % e)
 
 
+def load_librbd():
+    """
+    Load the librbd shared library.
+
+    The library is only looked up and loaded once, and its function
+    prototypes set up then; later calls return the same handle.
+    """
+    global _librbd
+    if _librbd is None:
+        with _librbd_lock:
+            if _librbd is None:
+                librbd = _open_librbd()
+                _configure_prototypes(librbd)
+                _librbd = librbd
+    return _librbd
+
+
 class RBD(object):
     """
     This class wraps librbd CRUD functions.
@@ -425,6 +482,8 @@ class Image(object):
         self.librbd = load_librbd()
         self.image = c_void_p()
         self.name = name
+        self.complete_cbs = {}
+        self.lock = threading.Lock()
         if not isinstance(name, str_type):
             raise TypeError('name must be a string')
         if snapshot is not None and not isinstance(snapshot, str_type):
@@ -803,6 +862,42 @@ class Image(object):
 
         return ctypes.string_at(ret_buf, ret)
 
+    def readinto(self, buffer, offset, fadvise_flags=0):
+        """
+        Read data from the image directly into a writable buffer, such
+        as a bytearray, mmap or memoryview. The length of the read is
+        the size of the buffer. Unlike :func:`read`, this does not
+        allocate or copy. Raises :class:`InvalidArgument` if part of
+        the range is outside the image.
+
+        :param buffer: where to put the data
+        :type buffer: writable buffer
+        :param offset: the offset to start reading at
+        :type offset: int
+        :param fadvise_flags: fadvise flags for this read
+        :type fadvise_flags: int
+        :returns: int - the number of bytes read
+        :raises: :class:`InvalidArgument`, :class:`IOError`
+        """
+        view = memoryview(buffer)
+        if view.readonly:
+            raise TypeError('buffer must be writable')
+        length = view.nbytes
+        if length == 0:
+            return 0
+        c_buf = (c_char * length).from_buffer(view)
+        if fadvise_flags == 0:
+            ret = self.librbd.rbd_read(self.image, c_uint64(offset),
+                                       c_size_t(length), byref(c_buf))
+        else:
+            ret = self.librbd.rbd_read2(self.image, c_uint64(offset),
+                                        c_size_t(length), byref(c_buf),
+                                        c_int(fadvise_flags))
+        del c_buf
+        if ret < 0:
+            raise make_ex(ret, 'error reading %s %ld~%ld' % (self.image, offset, length))
+        return ret
+
     def diff_iterate(self, offset, length, from_snapshot, iterate_cb,
                      include_parent = True, whole_object = False):
         """
@@ -847,7 +942,6 @@ class Image(object):
         if from_snapshot is not None and not isinstance(from_snapshot, str_type):
             raise TypeError('client must be a string')
 
-        RBD_DIFF_CB = CFUNCTYPE(c_int, c_uint64, c_size_t, c_int, c_void_p)
         cb_holder = DiffIterateCB(iterate_cb)
         cb = RBD_DIFF_CB(cb_holder.callback)
         ret = self.librbd.rbd_diff_iterate2(self.image,
@@ -858,6 +952,8 @@ class Image(object):
                                             c_uint8(whole_object),
                                             cb,
                                             c_void_p(None))
+        if cb_holder.exception is not None:
+            raise cb_holder.exception
         if ret < 0:
             msg = 'error generating diff from snapshot %s' % from_snapshot
             raise make_ex(ret, msg)
@@ -900,6 +996,198 @@ class Image(object):
 returned %d, but %d was the maximum number of bytes it could have \
 written." % (self.name, ret, length))
 
+    def __aio_complete_cb(self, completion, _):
+        """
+        Callback to oncomplete() for asynchronous operations
+        """
+        with self.lock:
+            cb = self.complete_cbs.pop(completion)
+        cb.oncomplete(cb)
+
+    def __get_completion(self, oncomplete):
+        """
+        Constructs a completion to use with asynchronous operations
+
+        :param oncomplete: what to do when the operation is complete
+        :type oncomplete: completion
+
+        :raises: :class:`Error`
+        :returns: completion object
+        """
+        completion = c_void_p(0)
+        complete_cb = RBD_CALLBACK(self.__aio_complete_cb)
+        ret = self.librbd.rbd_aio_create_completion(c_void_p(0), complete_cb,
+                                                    byref(completion))
+        if ret < 0:
+            raise make_ex(ret, "error getting a completion")
+        completion_obj = Completion(self, completion, oncomplete, complete_cb)
+        with self.lock:
+            self.complete_cbs[completion.value] = completion_obj
+        return completion_obj
+
+    def __forget_completion(self, completion):
+        # The operation was never queued, so the callback will not run
+        with self.lock:
+            self.complete_cbs.pop(completion.rbd_comp.value, None)
+
+    def aio_read(self, offset, length, oncomplete, fadvise_flags=0):
+        """
+        Asynchronously read data from the image
+
+        Raises :class:`InvalidArgument` if part of the range specified is
+        outside the image.
+
+        oncomplete will be called with the returned read value as
+        well as the completion:
+
+        oncomplete(completion, data_read)
+
+        :param offset: the offset to start reading at
+        :type offset: int
+        :param length: how many bytes to read
+        :type length: int
+        :param oncomplete: what to do when the read is complete
+        :type oncomplete: completion
+        :param fadvise_flags: fadvise flags for this read
+        :type fadvise_flags: int
+        :returns: :class:`Completion` - the completion object
+        :raises: :class:`InvalidArgument`, :class:`IOError`
+        """
+        buf = create_string_buffer(length)
+
+        def oncomplete_(completion_v):
+            return_value = completion_v.get_return_value()
+            return oncomplete(completion_v,
+                              ctypes.string_at(buf, return_value) if return_value >= 0 else None)
+
+        completion = self.__get_completion(oncomplete_)
+        completion.buf = buf
+        if fadvise_flags == 0:
+            ret = self.librbd.rbd_aio_read(self.image, c_uint64(offset),
+                                           c_size_t(length), buf,
+                                           completion.rbd_comp)
+        else:
+            ret = self.librbd.rbd_aio_read2(self.image, c_uint64(offset),
+                                            c_size_t(length), buf,
+                                            completion.rbd_comp,
+                                            c_int(fadvise_flags))
+        if ret < 0:
+            self.__forget_completion(completion)
+            raise make_ex(ret, 'error reading %s %ld~%ld' % (self.name, offset, length))
+        return completion
+
+    def aio_readinto(self, buffer, offset, oncomplete, fadvise_flags=0):
+        """
+        Asynchronously read data from the image directly into a writable
+        buffer. The length of the read is the size of the buffer, which
+        must not be resized or freed until the read completes.
+
+        oncomplete will be called with the completion and the buffer:
+
+        oncomplete(completion, buffer)
+
+        Use :func:`Completion.get_return_value` to get the number of
+        bytes read, or the negative error code.
+
+        :param buffer: where to put the data
+        :type buffer: writable buffer
+        :param offset: the offset to start reading at
+        :type offset: int
+        :param oncomplete: what to do when the read is complete
+        :type oncomplete: completion
+        :param fadvise_flags: fadvise flags for this read
+        :type fadvise_flags: int
+        :returns: :class:`Completion` - the completion object
+        :raises: :class:`InvalidArgument`, :class:`IOError`
+        """
+        view = memoryview(buffer)
+        if view.readonly:
+            raise TypeError('buffer must be writable')
+        length = view.nbytes
+        c_buf = (c_char * length).from_buffer(view)
+
+        def oncomplete_(completion_v):
+            # Drop our reference to the buffer before handing it back
+            completion_v.buf = None
+            return oncomplete(completion_v, buffer)
+
+        completion = self.__get_completion(oncomplete_)
+        completion.buf = c_buf
+        if fadvise_flags == 0:
+            ret = self.librbd.rbd_aio_read(self.image, c_uint64(offset),
+                                           c_size_t(length), c_buf,
+                                           completion.rbd_comp)
+        else:
+            ret = self.librbd.rbd_aio_read2(self.image, c_uint64(offset),
+                                            c_size_t(length), c_buf,
+                                            completion.rbd_comp,
+                                            c_int(fadvise_flags))
+        if ret < 0:
+            self.__forget_completion(completion)
+            raise make_ex(ret, 'error reading %s %ld~%ld' % (self.name, offset, length))
+        return completion
+
+    def aio_write(self, data, offset, oncomplete, fadvise_flags=0):
+        """
+        Asynchronously write data to the image
+
+        Raises :class:`InvalidArgument` if part of the write would fall
+        outside the image.
+
+        oncomplete will be called with the completion:
+
+        oncomplete(completion)
+
+        :param data: the data to be written
+        :type data: bytes
+        :param offset: the offset to start writing at
+        :type offset: int
+        :param oncomplete: what to do when the write is complete
+        :type oncomplete: completion
+        :param fadvise_flags: fadvise flags for this write
+        :type fadvise_flags: int
+        :returns: :class:`Completion` - the completion object
+        :raises: :class:`InvalidArgument`, :class:`IOError`
+        """
+        if not isinstance(data, bytes):
+            raise TypeError('data must be a byte string')
+        length = len(data)
+        completion = self.__get_completion(oncomplete)
+        completion.buf = data
+        if fadvise_flags == 0:
+            ret = self.librbd.rbd_aio_write(self.image, c_uint64(offset),
+                                            c_size_t(length), c_char_p(data),
+                                            completion.rbd_comp)
+        else:
+            ret = self.librbd.rbd_aio_write2(self.image, c_uint64(offset),
+                                             c_size_t(length), c_char_p(data),
+                                             completion.rbd_comp,
+                                             c_int(fadvise_flags))
+        if ret < 0:
+            self.__forget_completion(completion)
+            raise make_ex(ret, 'error writing %s %ld~%ld' % (self.name, offset, length))
+        return completion
+
+    def aio_flush(self, oncomplete):
+        """
+        Asynchronously wait until all writes are fully flushed if caching
+        is enabled.
+
+        oncomplete will be called with the completion:
+
+        oncomplete(completion)
+
+        :param oncomplete: what to do when the flush is complete
+        :type oncomplete: completion
+        :returns: :class:`Completion` - the completion object
+        """
+        completion = self.__get_completion(oncomplete)
+        ret = self.librbd.rbd_aio_flush(self.image, completion.rbd_comp)
+        if ret < 0:
+            self.__forget_completion(completion)
+            raise make_ex(ret, 'error flushing image')
+        return completion
+
     def discard(self, offset, length):
         """
         Trim the range from the image. It will be logically filled
@@ -1086,12 +1374,67 @@ written." % (self.name, ret, length))
             raise make_ex(ret, 'error unlocking image')
 
 
+class Completion(object):
+    """completion object"""
+    def __init__(self, image, rbd_comp, oncomplete, complete_cb):
+        self.image = image
+        self.rbd_comp = rbd_comp
+        self.oncomplete = oncomplete
+        self.complete_cb = complete_cb
+        # Keeps the buffer for the operation alive until it completes
+        self.buf = None
+
+    def is_complete(self):
+        """
+        Has an asynchronous operation completed?
+
+        This does not imply that the callback has finished.
+
+        :returns: True if the operation is completed
+        """
+        return self.image.librbd.rbd_aio_is_complete(self.rbd_comp) == 1
+
+    def wait_for_complete(self):
+        """
+        Wait for an asynchronous operation to complete
+
+        This does not imply that the callback has finished.
+        """
+        self.image.librbd.rbd_aio_wait_for_complete(self.rbd_comp)
+
+    def get_return_value(self):
+        """
+        Get the return value of an asychronous operation
+
+        The return value is set when the operation is complete.
+
+        :returns: int - return value of the operation
+        """
+        return self.image.librbd.rbd_aio_get_return_value(self.rbd_comp)
+
+    def __del__(self):
+        """
+        Release a completion
+
+        Call this when you no longer need the completion. It may not be
+        freed immediately if the operation is not complete.
+        """
+        self.image.librbd.rbd_aio_release(self.rbd_comp)
+
+
 class DiffIterateCB(object):
     def __init__(self, cb):
         self.cb = cb
+        self.exception = None
 
     def callback(self, offset, length, exists, unused):
-        self.cb(offset, length, exists == 1)
+        # ctypes would only print an exception raised here, so keep it and
+        # make librbd stop iterating; diff_iterate raises it afterwards
+        try:
+            self.cb(offset, length, exists == 1)
+        except BaseException as e:
+            self.exception = e
+            return -errno.ECANCELED
         return 0
 
 
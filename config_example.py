@@ -14,3 +14,8 @@ pool = PoolConfig(
 jobs: list[Job] = [
     Job(name='Backup VM Images', cluster=cluster, pools=[pool])
 ]
+
+# Optional - limits on how many images are backed up at once across all jobs
+scheduler = SchedulerConfig(
+    max_image_workers=8,
+)
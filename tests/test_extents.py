@@ -0,0 +1,96 @@
+import unittest
+
+from ceph_to_zfs.extents import ExtentCoalescer
+
+KiB = 1024
+
+
+class ExtentCoalescerTest(unittest.TestCase):
+    def coalesce(self, extents, **kwargs) -> list[tuple[int, int, bool]]:
+        submitted = []
+        coalescer = ExtentCoalescer(lambda offset, length, exists: submitted.append((offset, length, exists)),
+                                    **kwargs)
+        for extent in extents:
+            coalescer(*extent)
+        coalescer.flush()
+        return submitted
+
+    def test_passes_through_without_alignment(self):
+        self.assertEqual(self.coalesce([(0, 4 * KiB, True), (8 * KiB, 4 * KiB, False)], image_size=64 * KiB),
+                         [(0, 4 * KiB, True), (8 * KiB, 4 * KiB, False)])
+
+    def test_merges_touching_extents(self):
+        self.assertEqual(self.coalesce([(0, 4 * KiB, True), (4 * KiB, 4 * KiB, True),
+                                        (8 * KiB, 4 * KiB, False), (12 * KiB, 4 * KiB, False)],
+                                       image_size=64 * KiB),
+                         [(0, 8 * KiB, True), (8 * KiB, 8 * KiB, False)])
+
+    def test_rounds_data_out_to_block_size(self):
+        self.assertEqual(self.coalesce([(5 * KiB, 2 * KiB, True)], image_size=64 * KiB, block_size=16 * KiB),
+                         [(0, 16 * KiB, True)])
+
+    def test_clamps_to_image_size(self):
+        self.assertEqual(self.coalesce([(40 * KiB, 1 * KiB, True)], image_size=42 * KiB, block_size=16 * KiB),
+                         [(32 * KiB, 10 * KiB, True)])
+
+    def test_holes_are_not_rounded(self):
+        self.assertEqual(self.coalesce([(5 * KiB, 2 * KiB, False)], image_size=64 * KiB, block_size=16 * KiB),
+                         [(5 * KiB, 2 * KiB, False)])
+
+    def test_gap_only_filled_up_to_max_gap(self):
+        extents = [(0, 4 * KiB, True), (32 * KiB, 4 * KiB, True)]
+        self.assertEqual(self.coalesce(extents, image_size=64 * KiB, block_size=16 * KiB),
+                         [(0, 16 * KiB, True), (32 * KiB, 16 * KiB, True)])
+        self.assertEqual(self.coalesce(extents, image_size=64 * KiB, block_size=16 * KiB, max_gap=16 * KiB),
+                         [(0, 48 * KiB, True)])
+
+    def test_holes_do_not_bridge_gaps(self):
+        self.assertEqual(self.coalesce([(0, 4 * KiB, False), (8 * KiB, 4 * KiB, False)],
+                                       image_size=64 * KiB, max_gap=16 * KiB),
+                         [(0, 4 * KiB, False), (8 * KiB, 4 * KiB, False)])
+
+    def test_data_and_holes_in_one_block_are_submitted_once(self):
+        # 4K data, 4K hole, 8K data in every 16K block
+        extents = []
+        for block in range(0, 1024 * KiB, 16 * KiB):
+            extents += [(block, 4 * KiB, True), (block + 4 * KiB, 4 * KiB, False), (block + 8 * KiB, 8 * KiB, True)]
+        submitted = self.coalesce(extents, image_size=1024 * KiB, block_size=16 * KiB, max_length=256 * KiB)
+        self.assertEqual(submitted, [(offset, 256 * KiB, True) for offset in range(0, 1024 * KiB, 256 * KiB)])
+
+    def test_no_overlap_when_max_length_refuses_merge(self):
+        submitted = self.coalesce([(0, 4 * KiB, True), (12 * KiB, 8 * KiB, True)],
+                                  image_size=64 * KiB, block_size=16 * KiB, max_length=16 * KiB)
+        self.assertEqual(submitted, [(0, 16 * KiB, True), (16 * KiB, 16 * KiB, True)])
+
+    def test_hole_before_data_in_same_block_is_trimmed(self):
+        submitted = self.coalesce([(0, 4 * KiB, False), (16 * KiB, 4 * KiB, False), (24 * KiB, 4 * KiB, True)],
+                                  image_size=64 * KiB, block_size=16 * KiB)
+        self.assertEqual(submitted, [(0, 4 * KiB, False), (16 * KiB, 16 * KiB, True)])
+
+    def test_hole_partly_covered_by_data_keeps_the_rest(self):
+        submitted = self.coalesce([(0, 4 * KiB, True), (4 * KiB, 28 * KiB, False)],
+                                  image_size=64 * KiB, block_size=16 * KiB)
+        self.assertEqual(submitted, [(0, 16 * KiB, True), (16 * KiB, 16 * KiB, False)])
+
+    def test_submitted_hole_is_not_rounded_over(self):
+        submitted = self.coalesce([(0, 4 * KiB, False), (8 * KiB, 2 * KiB, False), (12 * KiB, 1 * KiB, True)],
+                                  image_size=64 * KiB, block_size=16 * KiB)
+        self.assertEqual(submitted, [(0, 16 * KiB, True)])
+
+    def test_holes_in_earlier_blocks_are_submitted(self):
+        submitted = self.coalesce([(0, 4 * KiB, False), (8 * KiB, 2 * KiB, False), (20 * KiB, 1 * KiB, False),
+                                   (24 * KiB, 1 * KiB, False), (28 * KiB, 1 * KiB, True)],
+                                  image_size=64 * KiB, block_size=16 * KiB)
+        self.assertEqual(submitted, [(0, 4 * KiB, False), (8 * KiB, 2 * KiB, False), (16 * KiB, 16 * KiB, True)])
+
+    def test_merged_gap_drops_holes_inside_it(self):
+        submitted = self.coalesce([(0, 4 * KiB, True), (20 * KiB, 4 * KiB, False), (36 * KiB, 4 * KiB, True)],
+                                  image_size=64 * KiB, block_size=16 * KiB, max_gap=16 * KiB)
+        self.assertEqual(submitted, [(0, 48 * KiB, True)])
+
+    def test_ignores_empty_extents(self):
+        self.assertEqual(self.coalesce([(0, 0, True)], image_size=64 * KiB), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,127 @@
+import os
+import random
+import tempfile
+import unittest
+
+from ceph_to_zfs.hashindex import BlockHashIndex
+
+KiB = 1024
+BLOCK = 4 * KiB
+
+
+class BlockHashIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.rng = random.Random(1234)
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, 'index.hashes')
+
+    def open(self, size: int = 64 * BLOCK, block_size: int = BLOCK) -> BlockHashIndex:
+        return BlockHashIndex(self.path, block_size, size)
+
+    def test_second_identical_pass_skips_everything(self):
+        data = self.rng.randbytes(16 * BLOCK)
+        with self.open() as index:
+            self.assertEqual(index.changed_runs(data, 8 * BLOCK), [(0, len(data))])
+            self.assertEqual(index.changed_runs(data, 8 * BLOCK), [])
+
+    def test_only_changed_blocks_are_reported(self):
+        data = bytearray(self.rng.randbytes(16 * BLOCK))
+        with self.open() as index:
+            index.changed_runs(data, 0)
+            data[5 * BLOCK] ^= 1
+            data[6 * BLOCK + 10] ^= 1
+            data[-1] ^= 1
+            self.assertEqual(index.changed_runs(data, 0), [(5 * BLOCK, 7 * BLOCK), (15 * BLOCK, 16 * BLOCK)])
+            self.assertEqual(index.changed_runs(data, 0), [])
+
+    def test_zeroed_blocks_match_zeroes(self):
+        with self.open() as index:
+            index.zeroed(0, 8 * BLOCK)
+            self.assertEqual(index.changed_runs(bytes(8 * BLOCK), 0), [])
+
+    def test_clean_index_survives_reopening(self):
+        data = self.rng.randbytes(16 * BLOCK)
+        with self.open() as index:
+            self.assertFalse(index.valid_for(42))
+            index.mark_dirty()
+            index.changed_runs(data, 0)
+            index.mark_clean(42)
+        with self.open() as index:
+            self.assertTrue(index.valid_for(42))
+            self.assertFalse(index.valid_for(43))
+            self.assertFalse(index.valid_for(None))
+            self.assertEqual(index.changed_runs(data, 0), [])
+            index.mark_dirty()
+        with self.open() as index:
+            self.assertFalse(index.valid_for(42))
+
+    def test_valid_for_never_trusts_guid_zero(self):
+        with self.open() as index:
+            index.mark_clean(0)
+            self.assertFalse(index.valid_for(0))
+
+    def test_block_size_change_discards_hashes(self):
+        data = self.rng.randbytes(16 * BLOCK)
+        with self.open() as index:
+            index.changed_runs(data, 0)
+            index.mark_clean(42)
+        with self.open(block_size=2 * BLOCK) as index:
+            self.assertFalse(index.valid_for(42))
+            self.assertEqual(index.changed_runs(data, 0), [(0, len(data))])
+
+    def test_growing_the_image_keeps_hashes(self):
+        data = self.rng.randbytes(16 * BLOCK)
+        with self.open() as index:
+            index.changed_runs(data, 0)
+            index.mark_clean(42)
+        with self.open(size=128 * BLOCK) as index:
+            self.assertTrue(index.valid_for(42))
+            self.assertEqual(index.changed_runs(data, 0), [])
+            self.assertEqual(index.changed_runs(data, 64 * BLOCK), [(0, len(data))])
+
+    def test_reset_forgets_hashes_and_leaves_the_file_sparse(self):
+        size = 64 * 1024 * BLOCK
+        data = self.rng.randbytes(BLOCK) * 1024
+        with self.open(size=size) as index:
+            for offset in range(0, size, len(data)):
+                index.update(data, offset)
+            index.mark_clean(42)
+            index.reset()
+            self.assertFalse(index.valid_for(42))
+            self.assertEqual(os.path.getsize(self.path), 64 + 64 * 1024 * 8)
+            # Only the header's page should be allocated
+            self.assertLessEqual(os.stat(self.path).st_blocks * 512, 64 * KiB)
+            self.assertEqual(index.changed_runs(data, 0), [(0, len(data))])
+            self.assertEqual(index.changed_runs(data, 0), [])
+
+    def test_partial_block_at_end_of_image_is_always_changed(self):
+        size = 8 * BLOCK + 100
+        data = self.rng.randbytes(BLOCK + 100)
+        with self.open(size=size) as index:
+            self.assertEqual(index.changed_runs(data, 7 * BLOCK), [(0, len(data))])
+            self.assertEqual(index.changed_runs(data, 7 * BLOCK), [(BLOCK, len(data))])
+
+    def test_unaligned_data_forgets_partly_covered_blocks(self):
+        data = self.rng.randbytes(4 * BLOCK)
+        with self.open() as index:
+            index.changed_runs(data, 0)
+            # Covers the second half of block 0, block 1 and the first half of block 2
+            middle = data[BLOCK // 2:5 * BLOCK // 2]
+            self.assertEqual(index.changed_runs(middle, BLOCK // 2),
+                             [(0, BLOCK // 2), (3 * BLOCK // 2, 2 * BLOCK)])
+            self.assertEqual(index.changed_runs(data, 0), [(0, BLOCK), (2 * BLOCK, 3 * BLOCK)])
+
+    def test_update_and_forget(self):
+        data = self.rng.randbytes(4 * BLOCK)
+        with self.open() as index:
+            index.update(data, 0)
+            index.forget(BLOCK + 1, 1)
+            self.assertEqual(index.changed_runs(data, 0), [(BLOCK, 2 * BLOCK)])
+            # An unaligned update forgets the blocks it doesn't cover whole
+            index.update(data[:BLOCK + 10], 2 * BLOCK)
+            self.assertEqual(index.changed_runs(data, 0), [(2 * BLOCK, 4 * BLOCK)])
+
+
+if __name__ == '__main__':
+    unittest.main()
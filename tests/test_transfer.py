@@ -0,0 +1,295 @@
+import os
+import random
+import tempfile
+import threading
+import unittest
+
+from ceph_to_zfs.buffers import BufferPool
+from ceph_to_zfs.hashindex import BlockHashIndex
+from ceph_to_zfs.statuslogger import JobLogger
+from ceph_to_zfs.transfer import TransferPipeline, TransferFailed
+from ceph_to_zfs.writers import PwriteWriter, DirectWriter, UringWriter
+
+KiB = 1024
+BLOCK = 4 * KiB
+SIZE = 256 * KiB
+WRITERS = [PwriteWriter, DirectWriter, UringWriter]
+
+
+class FakeCompletion:
+    def __init__(self, ret: int):
+        self.ret = ret
+
+    def get_return_value(self) -> int:
+        return self.ret
+
+
+class FakeAioImage:
+    """
+    Completes each read on its own thread, like librbd's callbacks.
+    """
+
+    def __init__(self, source: bytes, fail_at: int = None):
+        self.source = source
+        self.fail_at = fail_at
+        self.threads = []
+
+    def _complete(self, offset: int, length: int, oncomplete, into=None):
+        if offset == self.fail_at:
+            oncomplete(FakeCompletion(-5), None)
+        elif into is None:
+            oncomplete(FakeCompletion(length), self.source[offset:offset + length])
+        else:
+            into[:] = self.source[offset:offset + length]
+            oncomplete(FakeCompletion(length), into)
+
+    def aio_read(self, offset: int, length: int, oncomplete):
+        thread = threading.Thread(target=self._complete, args=(offset, length, oncomplete))
+        self.threads.append(thread)
+        thread.start()
+
+    def aio_readinto(self, buffer, offset: int, oncomplete):
+        thread = threading.Thread(target=self._complete, args=(offset, buffer.nbytes, oncomplete, buffer))
+        self.threads.append(thread)
+        thread.start()
+
+
+class TransferPipelineTest(unittest.TestCase):
+    def setUp(self):
+        self.rng = random.Random(1234)
+        self.source = self.rng.randbytes(SIZE)
+        fd, self.path = tempfile.mkstemp()
+        os.close(fd)
+        self.fill(self.rng.randbytes(SIZE))
+        self.logger = JobLogger('test', log_func=lambda path, message: None)
+
+    def tearDown(self):
+        os.unlink(self.path)
+
+    def fill(self, data: bytes):
+        with open(self.path, 'wb') as f:
+            f.write(data)
+
+    def contents(self) -> bytes:
+        with open(self.path, 'rb') as f:
+            return f.read()
+
+    def read(self, offset: int, length: int) -> bytes:
+        return self.source[offset:offset + length]
+
+    def run_pipeline(self, extents, writer_class=PwriteWriter, read_func=None, **kwargs) -> TransferPipeline:
+        options = dict(read_workers=2, queue_depth=8, max_bytes_in_flight=64 * KiB)
+        options.update(kwargs)
+        with writer_class(self.path) as device:
+            pipeline = TransferPipeline(self.logger, read_func or self.read, device, **options)
+            with pipeline:
+                for offset, length, exists in extents:
+                    pipeline.submit(offset, length, exists)
+        return pipeline
+
+    def expected(self, extents, old: bytes) -> bytes:
+        expected = bytearray(old)
+        for offset, length, exists in extents:
+            expected[offset:offset + length] = self.source[offset:offset + length] if exists else bytes(length)
+        return bytes(expected)
+
+    def random_extents(self, count: int = 40):
+        offsets = sorted(self.rng.sample(range(0, SIZE - 8 * KiB, 512), count))
+        extents = []
+        end = 0
+        for offset in offsets:
+            offset = max(offset, end)
+            length = self.rng.randrange(1, 8 * KiB)
+            extents.append((offset, length, True))
+            end = offset + length
+        return extents
+
+    def test_copies_extents_with_every_writer(self):
+        extents = self.random_extents()
+        for writer_class in WRITERS:
+            with self.subTest(writer=writer_class.__name__):
+                old = self.contents()
+                pipeline = self.run_pipeline(extents, writer_class)
+                self.assertEqual(pipeline.failures, [])
+                self.assertEqual(self.contents(), self.expected(extents, old))
+                total = sum(extent[1] for extent in extents)
+                self.assertEqual(pipeline.stats.requested, total)
+                self.assertEqual(pipeline.stats.written, total)
+                self.assertEqual(pipeline.stats.read_bytes, total)
+
+    def test_discards_extents_which_do_not_exist(self):
+        extents = [(0, 8 * KiB, True), (8 * KiB, 16 * KiB, False), (100 * KiB + 5, 3 * KiB, False)]
+        for writer_class in WRITERS:
+            with self.subTest(writer=writer_class.__name__):
+                old = self.contents()
+                reads = []
+                pipeline = self.run_pipeline(extents, writer_class, discard_block_size=BLOCK,
+                                             read_func=lambda offset, length: reads.append(offset) or
+                                             self.read(offset, length))
+                self.assertEqual(self.contents(), self.expected(extents, old))
+                self.assertEqual(reads, [0])
+                self.assertEqual(pipeline.stats.discarded, 19 * KiB)
+
+    def test_stays_within_queue_depth_and_byte_budget(self):
+        peaks = {'extents': 0, 'bytes': 0}
+        pipeline_ref = []
+
+        def read(offset: int, length: int) -> bytes:
+            pipeline = pipeline_ref[0]
+            with pipeline._budget:
+                peaks['extents'] = max(peaks['extents'], pipeline._extents_in_flight)
+                peaks['bytes'] = max(peaks['bytes'], pipeline._bytes_in_flight)
+            return self.read(offset, length)
+
+        extents = [(offset, 4 * KiB, True) for offset in range(0, SIZE, 4 * KiB)]
+        for queue_depth, max_bytes in ((4, 1024 * KiB), (64, 12 * KiB)):
+            with self.subTest(queue_depth=queue_depth, max_bytes=max_bytes):
+                peaks.update(extents=0, bytes=0)
+                with PwriteWriter(self.path) as device:
+                    pipeline = TransferPipeline(self.logger, read, device, read_workers=4, queue_depth=queue_depth,
+                                                max_bytes_in_flight=max_bytes)
+                    pipeline_ref[:] = [pipeline]
+                    with pipeline:
+                        for extent in extents:
+                            pipeline.submit(*extent)
+                self.assertLessEqual(peaks['extents'], queue_depth)
+                self.assertLessEqual(peaks['bytes'], max_bytes)
+                self.assertEqual(pipeline._extents_in_flight, 0)
+                self.assertEqual(pipeline._bytes_in_flight, 0)
+
+    def test_extent_larger_than_byte_budget_goes_through_alone(self):
+        extents = [(0, 128 * KiB, True)]
+        old = self.contents()
+        pipeline = self.run_pipeline(extents, max_bytes_in_flight=16 * KiB)
+        self.assertEqual(pipeline.failures, [])
+        self.assertEqual(self.contents(), self.expected(extents, old))
+
+    def test_read_failure_stops_submit(self):
+        def read(offset: int, length: int) -> bytes:
+            if offset == 16 * KiB:
+                raise IOError('read failed')
+            return self.read(offset, length)
+
+        with PwriteWriter(self.path) as device:
+            pipeline = TransferPipeline(self.logger, read, device, read_workers=1, queue_depth=1,
+                                        max_bytes_in_flight=64 * KiB)
+            with self.assertRaises(TransferFailed):
+                with pipeline:
+                    for offset in range(0, SIZE, 4 * KiB):
+                        pipeline.submit(offset, 4 * KiB, True)
+        self.assertEqual(len(pipeline.failures), 1)
+        self.assertEqual(pipeline._extents_in_flight, 0)
+
+    def test_short_read_is_a_failure(self):
+        pipeline = self.run_pipeline([(0, 4 * KiB, True)], read_func=lambda offset, length: bytes(length - 1))
+        self.assertEqual(len(pipeline.failures), 1)
+        self.assertIsInstance(pipeline.failures[0], TransferFailed)
+
+    def test_write_failure_is_reported(self):
+        class FailingWriter(PwriteWriter):
+            def write_extents(self, extents):
+                raise OSError(5, 'write failed')
+
+        pipeline = self.run_pipeline([(0, 4 * KiB, True)], FailingWriter)
+        self.assertEqual(len(pipeline.failures), 1)
+        self.assertEqual(pipeline.stats.written, 0)
+
+    def test_aio_reads(self):
+        extents = self.random_extents()
+        for buffer_pool in (None, BufferPool(8 * KiB)):
+            with self.subTest(buffer_pool=buffer_pool is not None):
+                old = self.contents()
+                image = FakeAioImage(self.source)
+                pipeline = self.run_pipeline(extents, aio_image=image, buffer_pool=buffer_pool)
+                self.assertEqual(pipeline.failures, [])
+                self.assertEqual(self.contents(), self.expected(extents, old))
+
+    def test_aio_read_failure_stops_submit(self):
+        image = FakeAioImage(self.source, fail_at=16 * KiB)
+        with PwriteWriter(self.path) as device:
+            pipeline = TransferPipeline(self.logger, self.read, device, read_workers=1, queue_depth=1,
+                                        max_bytes_in_flight=64 * KiB, aio_image=image)
+            with self.assertRaises(TransferFailed):
+                with pipeline:
+                    for offset in range(0, SIZE, 4 * KiB):
+                        pipeline.submit(offset, 4 * KiB, True)
+        for thread in image.threads:
+            thread.join()
+        self.assertEqual(len(pipeline.failures), 1)
+        self.assertEqual(pipeline._aio_outstanding, 0)
+
+    def test_readinto_reuses_pooled_buffers(self):
+        buffers = set()
+
+        def readinto(view: memoryview, offset: int) -> int:
+            buffers.add(id(view.obj))
+            view[:] = self.source[offset:offset + view.nbytes]
+            return view.nbytes
+
+        extents = [(offset, 4 * KiB, True) for offset in range(0, SIZE - 32 * KiB, 4 * KiB)]
+        # Doesn't fit in a buffer, so it is read with read_func
+        extents.append((SIZE - 32 * KiB, 20 * KiB, True))
+        old = self.contents()
+        pipeline = self.run_pipeline(extents, readinto_func=readinto, buffer_pool=BufferPool(8 * KiB),
+                                     queue_depth=4)
+        self.assertEqual(pipeline.failures, [])
+        self.assertEqual(self.contents(), self.expected(extents, old))
+        self.assertLess(len(buffers), 10)
+
+    def test_skips_zeroes_on_new_device(self):
+        self.fill(bytes(SIZE))
+        source = bytearray(self.source)
+        source[8 * KiB:20 * KiB] = bytes(12 * KiB)
+        self.source = bytes(source)
+        extents = [(0, 32 * KiB, True), (32 * KiB, 32 * KiB, False)]
+        pipeline = self.run_pipeline(extents, zero_chunk_size=BLOCK, discard_block_size=BLOCK)
+        self.assertEqual(self.contents(), self.expected(extents, bytes(SIZE)))
+        self.assertEqual(pipeline.stats.skipped, 12 * KiB + 32 * KiB)
+        self.assertEqual(pipeline.stats.written, 20 * KiB)
+        self.assertEqual(pipeline.stats.discarded, 0)
+
+    def test_compare_skips_unchanged_blocks(self):
+        old = bytearray(self.contents())
+        old[16 * KiB:40 * KiB] = self.source[16 * KiB:40 * KiB]
+        self.fill(bytes(old))
+        extents = [(0, 64 * KiB, True)]
+        for writer_class in WRITERS:
+            with self.subTest(writer=writer_class.__name__):
+                self.fill(bytes(old))
+                pipeline = self.run_pipeline(extents, writer_class, compare_chunk_size=BLOCK)
+                self.assertEqual(self.contents(), self.expected(extents, bytes(old)))
+                self.assertEqual(pipeline.stats.unchanged, 24 * KiB)
+                self.assertEqual(pipeline.stats.written, 40 * KiB)
+
+    def test_hash_index_skips_blocks_written_before(self):
+        extents = [(0, 64 * KiB, True), (100 * KiB + 512, 10 * KiB, True)]
+        with tempfile.TemporaryDirectory() as directory:
+            with BlockHashIndex(os.path.join(directory, 'index'), BLOCK, SIZE) as hash_index:
+                old = self.contents()
+                first = self.run_pipeline(extents, hash_index=hash_index)
+                self.assertEqual(first.stats.unchanged, 0)
+                self.assertEqual(self.contents(), self.expected(extents, old))
+
+                second = self.run_pipeline(extents, hash_index=hash_index)
+                # Only the one whole block of the unaligned extent is known
+                self.assertEqual(second.stats.unchanged, 64 * KiB + BLOCK)
+                self.assertEqual(second.stats.written, 10 * KiB - BLOCK)
+
+                source = bytearray(self.source)
+                source[4 * KiB] ^= 0xff
+                self.source = bytes(source)
+                third = self.run_pipeline([(0, 64 * KiB, True)], hash_index=hash_index)
+                self.assertEqual(third.stats.written, BLOCK)
+                self.assertEqual(self.contents()[:64 * KiB], self.source[:64 * KiB])
+
+    def test_hash_index_learns_discards(self):
+        with tempfile.TemporaryDirectory() as directory:
+            with BlockHashIndex(os.path.join(directory, 'index'), BLOCK, SIZE) as hash_index:
+                self.run_pipeline([(0, 16 * KiB, False)], discard_block_size=BLOCK, hash_index=hash_index)
+                self.source = bytes(16 * KiB) + self.source[16 * KiB:]
+                pipeline = self.run_pipeline([(0, 16 * KiB, True)], hash_index=hash_index)
+                self.assertEqual(pipeline.stats.unchanged, 16 * KiB)
+
+
+if __name__ == '__main__':
+    unittest.main()